@@ -1,5 +1,6 @@
 from ubgrade.grading_base import GradingBase
 from ubgrade.exam_code import ExamCode, covers_file
+from ubgrade.gradebook import read_csv, save_csv
 from ubgrade.helpers import merge_pdfs
 
 import os
@@ -10,7 +11,6 @@ import tempfile
 import shutil
 import subprocess
 
-import pandas as pd
 import PyPDF2 as pdf
 
 from reportlab.lib.pagesizes import letter
@@ -37,13 +37,13 @@ class AssembleGradedExams(GradingBase):
 
         GradingBase.__init__(self, main_dir, gradebook, init_grading_data)
 
-        gradebook_df =  pd.read_csv(self.gradebook)
+        gradebook_df =  read_csv(self.gradebook)
 
         # add the column for student email addresses if needed; it will need to be
         # populated in order to send the exams back to students
         if self.email_column not in gradebook_df.columns:
             gradebook_df[self.email_column] = ""
-            gradebook_df.to_csv(self.gradebook, index=False)
+            save_csv(gradebook_df, self.gradebook)
 
         # flag indicating if flattening of pdf files can be performed
         self.can_flatten = True
@@ -218,30 +218,31 @@ class AssembleGradedExams(GradingBase):
         # draw the marker
         pdf_bytes = io.BytesIO()
 
+        g = self.table_geometry
         c = canvas.Canvas(pdf_bytes, pagesize=letter)
         c.setLineWidth(.5)
         # backdround marker square
         c.setStrokeColor("black")
         c.setFillColor("white")
-        c.rect(self.table_margin + self.box_left_pad + score*(self.box_size + self.box_spacing),
-            self.box_bottom,
-            self.box_size,
-            self.box_size,
+        c.rect(g.box_left(score),
+            g.box_bottom,
+            g.box_size,
+            g.box_size,
             stroke=1,
             fill=1)
         # foreground marker square
         c.setFillColorRGB(0.5, 0, 0)
-        c.rect(self.table_margin + self.box_left_pad + score*(self.box_size + self.box_spacing) + self.mark_margin,
-            self.box_bottom + self.mark_margin,
-            self.box_size - 2*self.mark_margin,
-            self.box_size - 2*self.mark_margin,
+        c.rect(g.box_left(score) + g.mark_margin,
+            g.box_bottom + g.mark_margin,
+            g.box_size - 2*g.mark_margin,
+            g.box_size - 2*g.mark_margin,
             stroke=0,
             fill=1)
         # marker label with the score
         c.setFont('Helvetica-Bold', 10)
         c.setFillColor("white")
-        c.drawCentredString(self.table_margin + self.box_left_pad + score*(self.box_size + self.box_spacing) + 0.5*self.box_size,
-                            self.box_bottom + 5*self.mark_margin,
+        c.drawCentredString(g.box_left(score) + 0.5*g.box_size,
+                            g.box_bottom + 5*g.mark_margin,
                             str(score))
         c.save()
 
@@ -302,7 +303,8 @@ class AssembleGradedExams(GradingBase):
         if extras is None:
             extras = {}
 
-        gradebook_df =  pd.read_csv(self.gradebook, converters={self.qr_code_column : str})
+        gradebook = self.get_gradebook()
+        gradebook_df = gradebook.df
 
         # get graded exam files
         files = glob.glob(os.path.join(self.for_grading_dir, "*page_*.pdf"))
@@ -334,7 +336,7 @@ class AssembleGradedExams(GradingBase):
             cover_copy = os.path.join(temp_dir, "copy_" + ex_code.base + ".pdf")
             shutil.copyfile(cover, cover_copy)
             qr = ex_code.get_exam_code()
-            record = gradebook_df.loc[gradebook_df[self.qr_code_column] == qr]
+            record = gradebook.qr_record(qr)
             scores = record[prob_cols]
             score_table_data = {}
             for k in prob_cols:
@@ -355,7 +357,7 @@ class AssembleGradedExams(GradingBase):
         print(f"Score tables added." + 40*" ")
 
         pages = sorted([f for f in glob.glob(os.path.join(temp_dir, "*.pdf")) if not ExamCode(f).is_cover()])
-        maxpoints = self.get_grading_data()["maxpoints"]
+        maxpoints = self.grading_state.get_maxpoints()
 
         # add score marks to exam pages
         print(f"Adding score marks..." + 40*" ")
@@ -370,7 +372,7 @@ class AssembleGradedExams(GradingBase):
                 page_copy = os.path.join(temp_dir, "copy_" + ex_code.base + ".pdf")
                 shutil.copyfile(page, page_copy)
                 qr = ex_code.get_exam_code()
-                record = gradebook_df.loc[gradebook_df[self.qr_code_column] == qr]
+                record = gradebook.qr_record(qr)
                 scores = record[prob_cols].values[0]
                 # get page/problem number
                 pagenum = ex_code.get_page_num()
@@ -1,5 +1,6 @@
 from ubgrade.grading_base import GradingBase
 from ubgrade.exam_code import ExamCode, covers_file
+from ubgrade.gradebook import read_csv, save_csv
 
 import os
 import glob
@@ -8,7 +9,6 @@ from time import sleep
 from email.message import EmailMessage
 import smtplib
 import getpass
-import pandas as pd
 
 
 
@@ -42,12 +42,12 @@ class EmailGradedExams(GradingBase):
         # for this many seconds and then resume sending exams
         self.reconnect_period = 300
 
-        gradebook_df =  pd.read_csv(self.gradebook)
+        gradebook_df =  read_csv(self.gradebook)
 
         # check if the column with student email addresses is present in the gradebook
         if self.email_column not in gradebook_df.columns:
             gradebook_df[self.email_column] = ""
-            gradebook_df.to_csv(self.gradebook, index=False)
+            save_csv(gradebook_df, self.gradebook)
             print("Email addresses missing in the gradebook, exiting")
             return None
 
@@ -143,12 +143,11 @@ class EmailGradedExams(GradingBase):
             print(f"Sending a sample message.\n")
 
         # get email addresses to which messages were previously sent
-        grading_data = self.get_grading_data()
-        emails_sent = set(grading_data["emails_sent"])
+        emails_sent = set(self.grading_state.get_emails_sent())
 
         # convert the gradebook into a list of dictionaries, one dictionary
         # for each gradebook row
-        gradebook_df = pd.read_csv(self.gradebook)
+        gradebook_df = read_csv(self.gradebook)
         gradebook_df = gradebook_df[gradebook_df[self.qr_code_column].notnull()]
         gradebook_df = gradebook_df[gradebook_df[self.email_column].notnull()]
         gradebook_dict = gradebook_df.to_dict(orient='records')
@@ -228,12 +227,10 @@ class EmailGradedExams(GradingBase):
                 break
             else:
                 # save information that the email was sent;
-                # we are saving it to the grading data file right away, in case
+                # we are saving it to the grading data right away, in case
                 # the program gets interrupted for some reason
                 if send_success:
                     emails_sent.add(to_address)
-                    grading_data = self.get_grading_data()
-                    grading_data["emails_sent"] = list(emails_sent)
-                    self.set_grading_data(grading_data)
+                    self.grading_state.add_email_sent(to_address)
         
         print("***FINISHED***")
\ No newline at end of file
@@ -17,14 +17,15 @@ class ExamCode():
 
         '''
         Check if the format of a QR code is valid, i.e. consist is a (possibly empty)
-        prefix followed by CXXX-PXX where X denotes a digit. A code t_CXXX-PXX also valid
+        prefix followed by CXXX-PXX where X denotes a digit (copy numbers can have more than
+        three digits). A code t_CXXX-PXX also valid
         to allow for names of files with a score table and an empty prefix.  
         '''
 
         tokens = self.base.split("-")
         if not len(tokens) >= 2:
             return False
-        if re.match(r"^(t_)?C\d{3}$", tokens[-2]) and re.match(r"^P\d{2}$", tokens[-1]):
+        if re.match(r"^(t_)?C\d{3,}$", tokens[-2]) and re.match(r"^P\d{2}$", tokens[-1]):
             return True
         else:
             return False
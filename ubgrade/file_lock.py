@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # on Windows file locks are provided by msvcrt
+    fcntl = None
+    import msvcrt
+
+
+
+class FileLock():
+
+    '''
+    Context manager locking a file, so that it is not modified by other processes
+    while it is being read or written. The lock is placed on an auxiliary file,
+    with ".lock" added to the name of the locked file, so that the locked file
+    itself can be replaced.
+
+    Several processes can hold shared locks at the same time, which is used by
+    processes reading the file. An exclusive lock, used by a process writing
+    the file, can be held by one process only, and excludes shared locks.
+    On Windows all locks are exclusive.
+
+    Locks are not reentrant: a process holding a lock on a file should not
+    try to lock this file again.
+    '''
+
+    def __init__(self, fname, shared = False):
+
+        '''
+        :fname:
+            The name of the file to be locked.
+        :shared:
+            Boolean. If True, a shared lock will be used, otherwise the lock will be exclusive.
+        '''
+
+        self.lock_fname = fname + ".lock"
+        self.shared = shared
+        self.lock_file = None
+
+
+    def __enter__(self):
+
+        self.lock_file = open(self.lock_fname, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        else:
+            self.lock_file.seek(0)
+            while True:
+                # LK_LOCK gives up after 10 seconds; keep waiting until the lock is released
+                try:
+                    msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.lock_file.seek(0)
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.lock_file.close()
+        self.lock_file = None
+
+
+
+@contextlib.contextmanager
+def atomic_write(fname, mode = 'w'):
+
+    '''
+    Context manager giving a file object which can be used to replace the content
+    of a file. The data is written to a temporary file in the same directory, which
+    after writing is completed is flushed to disk and renamed to the target file.
+    This way the target file is never left partially written: if the process
+    is interrupted or an exception is raised, the original file is unchanged.
+
+    :fname:
+        The name of the file.
+    :mode:
+        The mode in which the temporary file is opened, 'w' or 'wb'.
+    '''
+
+    dirname = os.path.dirname(os.path.abspath(fname))
+    fd, temp_fname = tempfile.mkstemp(dir = dirname, prefix = os.path.basename(fname) + ".", suffix = ".tmp")
+    # the temporary file is created with restricted permissions, use permissions
+    # of the original file or the default ones instead
+    if os.path.exists(fname):
+        shutil.copymode(fname, temp_fname)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_fname, 0o666 & ~umask)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_fname, fname)
+    except BaseException:
+        if os.path.exists(temp_fname):
+            os.remove(temp_fname)
+        raise
+
+    # make the rename durable; directories can't be opened this way on Windows
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
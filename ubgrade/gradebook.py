@@ -0,0 +1,209 @@
+import os
+import pandas as pd
+from ubgrade.file_lock import FileLock, atomic_write
+
+
+
+def read_csv(fname, **kwargs):
+
+    '''
+    Reads a csv file into a pandas dataframe. The file is locked while it is read,
+    so that it is not modified by other processes at that time. 
+
+    :fname:
+        The name of the csv file.
+    :kwargs:
+        Keyword arguments passed to pandas.read_csv.
+    '''
+
+    with FileLock(fname, shared = True):
+        return pd.read_csv(fname, **kwargs)
+
+
+
+def save_csv(df, fname):
+
+    '''
+    Saves a pandas dataframe to a csv file. The file is locked and replaced 
+    atomically, so it is never left partially written. 
+
+    :df:
+        The dataframe. 
+    :fname:
+        The name of the csv file.
+    '''
+
+    with FileLock(fname):
+        with atomic_write(fname) as f:
+            df.to_csv(f, index=False)
+
+
+
+class Gradebook():
+
+    '''
+    Class providing access to the gradebook file. Rows of the gradebook are
+    indexed by person numbers and by exam QR codes, so that records of students
+    can be found without scanning the whole gradebook.
+
+    Changes made with set_qr and add_row are recorded. When the gradebook file is
+    saved, it is read again while it is locked and the changes are applied to its 
+    current content, so changes saved by other processes in the meantime are not lost.
+    '''
+
+    def __init__(self, fname, pnum_column = "person_number", qr_code_column = "qr_code"):
+
+        '''
+        :fname:
+            The name of the csv file with the gradebook.
+        :pnum_column:
+            The name of the gradebook column with person numbers.
+        :qr_code_column:
+            The name of the gradebook column with QR codes of exams. If the
+            gradebook does not have this column, it will be added.
+        '''
+
+        self.fname = fname
+        self.pnum_column = pnum_column
+        self.qr_code_column = qr_code_column
+
+        # changes made since the gradebook was read, as tuples (method name, arguments)
+        self.changes = []
+
+        with FileLock(self.fname, shared = True):
+            self.read()
+
+
+    def read(self):
+
+        '''
+        Reads the gradebook file. The file should be locked by the caller.
+        '''
+
+        # person numbers and QR codes are read as strings, to preserve leading zeros
+        self.df = pd.read_csv(self.fname, converters={self.pnum_column : str, self.qr_code_column : str})
+        if self.qr_code_column not in self.df.columns:
+            self.df[self.qr_code_column] = ""
+
+        self.reindex()
+
+
+    def reindex(self):
+
+        '''
+        Rebuilds dictionaries mapping person numbers and QR codes to row labels
+        of the gradebook dataframe. If a person number or a QR code appears in
+        several rows, the first of these rows is used.
+        '''
+
+        self.pnum_index = {}
+        if self.pnum_column in self.df.columns:
+            for i, pnum in zip(self.df.index, self.df[self.pnum_column].values):
+                self.pnum_index.setdefault(pnum, i)
+
+        self.qr_index = {}
+        for i, qr in zip(self.df.index, self.df[self.qr_code_column].values):
+            if isinstance(qr, str) and qr != "":
+                self.qr_index.setdefault(qr, i)
+
+
+    def pnums(self):
+
+        '''
+        Returns a list of person numbers listed in the gradebook.
+        '''
+
+        return list(self.pnum_index)
+
+
+    def has_pnum(self, pnum):
+
+        '''
+        Checks if a person number is listed in the gradebook.
+        '''
+
+        return (pnum is not None) and (pnum in self.pnum_index)
+
+
+    def set_qr(self, pnum, qr):
+
+        '''
+        Records the QR code of an exam in the row of the gradebook with a given person number.
+
+        :pnum:
+            A person number listed in the gradebook.
+        :qr:
+            A string with the exam code (QR code of a page with the page number stripped).
+        '''
+
+        self.changes.append(("set_qr", (pnum, qr)))
+        i = self.pnum_index[pnum]
+        old_qr = self.df.loc[i, self.qr_code_column]
+        if self.qr_index.get(old_qr) == i:
+            del self.qr_index[old_qr]
+        self.df.loc[i, self.qr_code_column] = qr
+        self.qr_index.setdefault(qr, i)
+
+
+    def qr_record(self, qr):
+
+        '''
+        Returns a dataframe with the row of the gradebook corresponding to a given
+        exam code. The dataframe is empty if the exam code is not in the gradebook.
+        '''
+
+        i = self.qr_index.get(qr)
+        if i is None:
+            return self.df.iloc[0:0]
+        return self.df.loc[[i]]
+
+
+    def add_row(self, row):
+
+        '''
+        Appends a row to the gradebook.
+
+        :row:
+            A dictionary whose keys are names of gradebook columns, and values
+            are entries of the new row.
+        '''
+
+        row = dict(row)
+        self.changes.append(("add_row", (row,)))
+        row.setdefault(self.qr_code_column, "")
+        self.df = pd.concat([self.df, pd.DataFrame({k : [v] for k, v in row.items()})], sort = False, ignore_index = True)
+
+        i = self.df.index[-1]
+        if self.pnum_column in row:
+            self.pnum_index.setdefault(row[self.pnum_column], i)
+        if row[self.qr_code_column] != "":
+            self.qr_index.setdefault(row[self.qr_code_column], i)
+
+
+    def save(self, fname = None):
+
+        '''
+        Saves the gradebook to a csv file.
+
+        :fname:
+            The name of the file. If None, the gradebook file will be overwritten.
+        '''
+
+        if fname is not None and os.path.abspath(fname) != os.path.abspath(self.fname):
+            save_csv(self.df, fname)
+            return
+
+        # the file is locked from reading it until it is replaced, so that 
+        # no changes made by other processes are lost
+        with FileLock(self.fname):
+            changes = self.changes
+            self.read()
+            self.changes = []
+            for method, args in changes:
+                if method == "set_qr" and not self.has_pnum(args[0]):
+                    # the row with the person number was removed from the file
+                    self.add_row({self.pnum_column: args[0]})
+                getattr(self, method)(*args)
+            with atomic_write(self.fname) as f:
+                self.df.to_csv(f, index=False)
+        self.changes = []
@@ -1,10 +1,139 @@
 from ubgrade.helpers import pdf2pages
+from ubgrade.gradebook import Gradebook
+from ubgrade.grading_state import get_grading_state
 
 import os
-import json
 import glob
 import shutil
 from reportlab.lib.units import inch
+import numpy as np
+
+
+
+class ScoreTableGeometry():
+
+    '''
+    Dimensions of score tables embedded on exam pages. They are used to draw score
+    tables, to mark scores in them, and to find score boxes when scores are read. 
+    Lengths are given in pdf units (1/72 of an inch), and vertical positions are
+    measured from the bottom of the page.
+    '''
+
+    def __init__(self):
+
+        # page width and height
+        self.page_w = 8.5*inch
+        self.page_h = 11*inch
+        # margin of the score table
+        self.table_margin = 0.05*inch
+        # table height and width
+        self.table_h = 0.5*inch
+        self.table_w = self.page_w - 2*self.table_margin
+        # size of score boxes
+        self.box_size = 0.19*inch
+        # spacing of score boxes
+        self.box_spacing = 0.11*inch
+        # distance between the leftmost score box and the left edge of the score table
+        self.box_left_pad = 0.15*inch
+        # position of the bottom of score boxes
+        self.box_bottom = 0.28*inch
+        # vertical position of the textline of score box labels
+        self.text_label_bottom = 0.12*inch
+        # spacing between the size of a score box and score mark inserted into the box
+        self.mark_margin = 0.01*inch
+        # margin inside score boxes skipped when reading scores from page images, 
+        # so that box borders are not counted as marks
+        self.read_margin = 0.02*inch
+
+
+    def box_left(self, i):
+
+        '''
+        Returns the position of the left edge of the score box for the score i.
+        '''
+
+        return self.table_margin + self.box_left_pad + i*(self.box_size + self.box_spacing)
+
+
+    def box_rect(self, i, pad = 0):
+
+        '''
+        Returns the rectangle (x0, y0, x1, y1) of the score box for the score i.
+
+        :pad:
+            The rectangle is enlarged by pad on each side (or shrunk, if pad is negative).
+        '''
+
+        x = self.box_left(i)
+        return (x - pad, self.box_bottom - pad, x + self.box_size + pad, self.box_bottom + self.box_size + pad)
+
+
+    def to_pixels(self, x, y, dpi = 200, rotation = 0):
+
+        '''
+        Converts coordinates of a point on a page to pixel coordinates in an image of the page.
+
+        :x:
+        :y:
+            Coordinates of the point in pdf units, measured from the lower left corner of the page.
+        :dpi:
+            Resolution of the image.
+        :rotation:
+            Clockwise rotation of the page (the value of the /Rotate attribute of the page),
+            which is applied when the page is rendered.
+
+        Returns:
+            A tuple (column, row) of pixel coordinates, measured from the upper left corner 
+            of the image. 
+        '''
+
+        scale = dpi/72
+        rotation = rotation % 360
+        if rotation == 0:
+            return x*scale, (self.page_h - y)*scale
+        elif rotation == 90:
+            return y*scale, x*scale
+        elif rotation == 180:
+            return (self.page_w - x)*scale, y*scale
+        else:
+            return (self.page_h - y)*scale, (self.page_w - x)*scale
+
+
+    def pixel_rect(self, rect, dpi = 200, rotation = 0):
+
+        '''
+        Converts a rectangle (x0, y0, x1, y1) on a page to a rectangle of pixels 
+        (left, top, width, height) in an image of the page. Only pixels entirely 
+        inside the rectangle are included. 
+        '''
+
+        x0, y0, x1, y1 = rect
+        cols, rows = zip(self.to_pixels(x0, y0, dpi, rotation), self.to_pixels(x1, y1, dpi, rotation))
+        # rounding prevents floating point errors from shifting edges by a pixel
+        left, top = int(np.ceil(round(min(cols), 6))), int(np.ceil(round(min(rows), 6)))
+        right, bottom = int(np.floor(round(max(cols), 6))), int(np.floor(round(max(rows), 6)))
+        return left, top, max(right - left, 1), max(bottom - top, 1)
+
+
+    def pixel_boxes(self, maxpoints, dpi = 200, rotation = 0):
+
+        '''
+        Returns a list of rectangles of pixels (left, top, width, height) which are
+        checked for marks when scores are read from page images, one for each score box.
+        '''
+
+        return [self.pixel_rect(self.box_rect(i, pad = -self.read_margin), dpi, rotation) for i in range(maxpoints + 1)]
+
+
+
+def geometry_attribute(name):
+
+    '''
+    Returns a read-only property giving the value of an attribute of the score table 
+    geometry (the table_geometry attribute of GradingBase).
+    '''
+
+    return property(lambda self: getattr(self.table_geometry, name), doc = f"Score table dimension {name}, see ScoreTableGeometry.")
 
 
 
@@ -14,7 +143,20 @@ class GradingBase():
     Base class establishing file and directory structure used in grading.
     '''
 
-    def __init__(self, main_dir = None, gradebook = None, init_grading_data=False):
+    # dimensions of score tables, kept as attributes for compatibility; 
+    # they are defined by self.table_geometry
+    page_w = geometry_attribute("page_w")
+    table_margin = geometry_attribute("table_margin")
+    table_h = geometry_attribute("table_h")
+    table_w = geometry_attribute("table_w")
+    box_size = geometry_attribute("box_size")
+    box_spacing = geometry_attribute("box_spacing")
+    box_left_pad = geometry_attribute("box_left_pad")
+    box_bottom = geometry_attribute("box_bottom")
+    text_label_bottom = geometry_attribute("text_label_bottom")
+    mark_margin = geometry_attribute("mark_margin")
+
+    def __init__(self, main_dir = None, gradebook = None, init_grading_data=False, state_backend = "sqlite"):
 
         '''
         :main_dir:
@@ -32,6 +174,11 @@ class GradingBase():
         :init_grading_data:
             Bollean. If True, auxiliary files used in grading will be reset to the
             initial status, and the grading process will start from scratch.
+        :state_backend:
+            The backend used to store grading data: "sqlite" (the grading_data.db file)
+            or "json" (the grading_data.json file). If the sqlite backend is used and 
+            the main grading directory contains grading_data.json file, grading data 
+            will be imported from this file.
         '''
 
         if main_dir is None:
@@ -56,7 +203,7 @@ class GradingBase():
 
         # a pdf file used for exam pages where user input us needed to get QR code or person number
         self.missing_data_pages = os.path.join(self.scans_dir, "missing_data.pdf")
-        # a json file with data structures used in the grading process
+        # a json file with data structures used in the grading process, used by the json backend
         self.grading_data_jfile = os.path.join(self.main_dir, "grading_data.json")
 
 
@@ -75,15 +222,22 @@ class GradingBase():
         # page lists: when exams are assembled by problem, it records which file contains which exam pages and in which order
         # missing data: records which scanned pages require user input to get a QR code or person number
         # emails_sent: when graded exams are emailed to students, this list records which emails have been sent
+        # pnum_corrections: records person numbers which were misread or ambiguous, and were matched with the gradebook automatically
+        # score_cache: for each file with exams assembled by problem, scores read from its pages, keyed by digests of pages
         self.init_grading_data = {"maxpoints": {},
                                   "processed_scans": [],
                                   "page_lists" : {},
                                   "missing_data" : [],
-                                  "emails_sent" : []
+                                  "emails_sent" : [],
+                                  "pnum_corrections" : [],
+                                  "score_cache" : {}
                                   }
+        # an object giving access to the grading data
+        self.grading_state = get_grading_state(self.main_dir, self.init_grading_data, backend = state_backend)
+
         if init_grading_data:
             # remove grading data
-            self.set_grading_data(self.init_grading_data)
+            self.grading_state.reset()
             # remove missing pages
             if os.path.isfile(self.missing_data_pages):
                  os.remove(self.missing_data_pages)
@@ -104,37 +258,24 @@ class GradingBase():
 
 
         # dimensions of score tables embeded on the exam pages
-        # page width
-        self.page_w = 8.5*inch
-        # margin of the score table
-        self.table_margin = 0.05*inch
-        # table height and width
-        self.table_h = 0.5*inch
-        self.table_w = self.page_w - 2*self.table_margin
-        # size of score boxes
-        self.box_size = 0.19*inch
-        # spacing of score boxes
-        self.box_spacing = 0.11*inch
-        # distance between the leftmost score box and the left edge of the score table
-        self.box_left_pad = 0.15*inch
-        # position of the bottom of score boxes
-        self.box_bottom = 0.28*inch
-        # vertical position of the textline of score box labels
-        self.text_label_bottom = 0.12*inch
-        # spacing between the size of a score box and score mark inserted into the box
-        self.mark_margin = 0.01*inch
+        self.table_geometry = ScoreTableGeometry()
 
-    # functions used to read and write data from/to the self.grading_data_jfile file
+    # functions used to read and write all grading data; parts of the data 
+    # can be read and updated using methods of self.grading_state
     def get_grading_data(self):
-        if os.path.isfile(self.grading_data_jfile):
-            with open(self.grading_data_jfile) as foo:
-                return json.load(foo)
-        else:
-            return self.init_grading_data
+        return self.grading_state.get_data()
 
     def set_grading_data(self, data):
-        with open(self.grading_data_jfile, 'w') as foo:
-            json.dump(data, foo)
+        self.grading_state.set_data(data)
+
+
+    def get_gradebook(self):
+
+        '''
+        Returns a Gradebook object giving access to the self.gradebook file.
+        '''
+
+        return Gradebook(self.gradebook, pnum_column = self.pnum_column, qr_code_column = self.qr_code_column)
 
 
     def split_for_grading_files(self, dest_dir):
@@ -147,7 +288,7 @@ class GradingBase():
             The directory where the pdf files with exam pages will be saved.
         '''
 
-        page_lists = self.get_grading_data()["page_lists"]
+        page_lists = self.grading_state.get_page_lists()
 
         for f in page_lists:
             f_list = page_lists[f]
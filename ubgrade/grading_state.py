@@ -0,0 +1,587 @@
+import os
+import json
+import sqlite3
+from ubgrade.file_lock import FileLock, atomic_write
+
+
+
+class GradingState():
+
+    '''
+    Base class of backends storing data structures used in the grading process
+    (maximal scores, processed scans, page lists, missing data, emails sent,
+    person number corrections, cached scores). The data is given by a dictionary with the
+    structure of GradingBase.init_grading_data.
+
+    Subclasses must implement get_data and set_data. Other methods are implemented
+    here by reading and writing all data, and can be overridden by backends which
+    can update a part of the data without rewriting the rest.
+    '''
+
+    def __init__(self, init_data):
+
+        '''
+        :init_data:
+            A dictionary with the initial structure of the grading data.
+        '''
+
+        self.init_data = init_data
+
+
+    def get_data(self):
+
+        '''
+        Returns a dictionary with all grading data.
+        '''
+
+        raise NotImplementedError
+
+
+    def set_data(self, data):
+
+        '''
+        Replaces all grading data with the content of a dictionary.
+        '''
+
+        raise NotImplementedError
+
+
+    def reset(self):
+
+        '''
+        Resets grading data to the initial structure.
+        '''
+
+        self.set_data(self.init_data)
+
+
+    def get_item(self, key):
+        data = self.get_data()
+        if key in data:
+            return data[key]
+        # a copy of the initial value, so that it is not modified by the caller
+        return json.loads(json.dumps(self.init_data[key]))
+
+
+    def update_item(self, key, update):
+
+        '''
+        Updates a part of grading data.
+
+        :key:
+            The key of the grading data dictionary.
+        :update:
+            A function which takes the current value of the item and returns its new value.
+        '''
+
+        data = self.get_data()
+        data[key] = update(data.get(key, json.loads(json.dumps(self.init_data[key]))))
+        self.set_data(data)
+
+
+    def get_maxpoints(self):
+
+        '''
+        Returns a dictionary whose keys are exam page numbers (as strings) and values
+        are maximal scores for these pages.
+        '''
+
+        return self.get_item("maxpoints")
+
+
+    def update_maxpoints(self, maxpoints):
+
+        '''
+        Records maximal scores of exam pages.
+
+        :maxpoints:
+            A dictionary whose keys are exam page numbers (as strings) and values
+            are maximal scores for these pages.
+        '''
+
+        self.update_item("maxpoints", lambda data: dict(data, **maxpoints))
+
+
+    def get_processed_scans(self):
+
+        '''
+        Returns a list of names of scanned files which have been processed.
+        '''
+
+        return self.get_item("processed_scans")
+
+
+    def add_processed_scans(self, fnames):
+
+        '''
+        Records names of scanned files which have been processed.
+        '''
+
+        self.update_item("processed_scans", lambda data: data + [f for f in fnames if f not in data])
+
+
+    def get_page_lists(self):
+
+        '''
+        Returns a dictionary whose keys are names of files with exams assembled
+        by problem, and values are lists of names of exam pages in these files.
+        '''
+
+        return self.get_item("page_lists")
+
+
+    def set_page_list(self, fname, pages):
+
+        '''
+        Records the list of exam pages contained in a file with exams assembled
+        by problem.
+
+        :fname:
+            The name of the file.
+        :pages:
+            A list of names of exam pages, in the order they appear in the file.
+        '''
+
+        self.update_item("page_lists", lambda data: dict(data, **{fname : list(pages)}))
+
+
+    def get_missing_data(self):
+
+        '''
+        Returns a list of dictionaries with information about scanned pages
+        which require user input to get a QR code or a person number.
+        '''
+
+        return self.get_item("missing_data")
+
+
+    def set_missing_data(self, missing_data):
+        self.update_item("missing_data", lambda data: list(missing_data))
+
+
+    def add_missing_data(self, records):
+
+        '''
+        Appends records of pages with missing data to the list of such pages.
+        '''
+
+        self.update_item("missing_data", lambda data: data + list(records))
+
+
+    def get_emails_sent(self):
+
+        '''
+        Returns a list of email addresses to which graded exams have been sent.
+        '''
+
+        return self.get_item("emails_sent")
+
+
+    def add_email_sent(self, address):
+
+        self.update_item("emails_sent", lambda data: data if address in data else data + [address])
+
+
+    def get_pnum_corrections(self):
+
+        '''
+        Returns a list of dictionaries recording person numbers which were matched
+        with the gradebook automatically.
+        '''
+
+        return self.get_item("pnum_corrections")
+
+
+    def add_pnum_corrections(self, corrections):
+        self.update_item("pnum_corrections", lambda data: data + list(corrections))
+
+
+    def get_score_cache(self, fname):
+
+        '''
+        Returns a dictionary whose keys are digests of pages of a file with exams
+        assembled by problem, and values are scores read from these pages.
+
+        :fname:
+            The name of the file.
+        '''
+
+        return self.get_item("score_cache").get(fname, {})
+
+
+    def set_score_cache(self, fname, scores):
+
+        '''
+        Records scores read from pages of a file with exams assembled by problem, 
+        replacing scores previously recorded for this file.
+
+        :fname:
+            The name of the file.
+        :scores:
+            A dictionary whose keys are digests of pages and values are scores.
+        '''
+
+        self.update_item("score_cache", lambda data: dict(data, **{fname : dict(scores)}))
+
+
+
+class JsonGradingState(GradingState):
+
+    '''
+    Grading data stored in a json file. Each update rewrites the whole file.
+    The file is locked while it is read or written, and it is replaced 
+    atomically, so it is never left partially written.
+    '''
+
+    def __init__(self, fname, init_data):
+
+        '''
+        :fname:
+            The name of the json file.
+        :init_data:
+            A dictionary with the initial structure of the grading data.
+        '''
+
+        GradingState.__init__(self, init_data)
+        self.fname = fname
+
+
+    def read(self):
+        if os.path.isfile(self.fname):
+            with open(self.fname) as foo:
+                return json.load(foo)
+        else:
+            return json.loads(json.dumps(self.init_data))
+
+
+    def write(self, data):
+        with atomic_write(self.fname) as foo:
+            json.dump(data, foo)
+
+
+    def get_data(self):
+        with FileLock(self.fname, shared = True):
+            return self.read()
+
+
+    def set_data(self, data):
+        with FileLock(self.fname):
+            self.write(data)
+
+
+    def update_item(self, key, update):
+
+        # the file is locked until the update is saved, so that updates 
+        # made by other processes are not lost
+        with FileLock(self.fname):
+            data = self.read()
+            data[key] = update(data.get(key, json.loads(json.dumps(self.init_data[key]))))
+            self.write(data)
+
+
+
+class SqliteGradingState(GradingState):
+
+    '''
+    Grading data stored in an SQLite database, with a separate table for each
+    data structure. Updates modify only the affected rows, and each update is
+    a single transaction, so an interrupted process does not leave the data
+    in an inconsistent state. SQLite locks the database during updates, and
+    several processes can read it at the same time.
+
+    A connection to the database is opened for each operation, so the object
+    can be sent to worker processes.
+    '''
+
+    def __init__(self, fname, init_data, json_fname = None):
+
+        '''
+        :fname:
+            The name of the database file.
+        :init_data:
+            A dictionary with the initial structure of the grading data.
+        :json_fname:
+            The name of a json file with grading data saved by JsonGradingState.
+            If the database does not exist yet and this file exists, its data will be
+            imported into the database, and the file will be renamed by adding
+            the ".bak" extension.
+        '''
+
+        GradingState.__init__(self, init_data)
+        self.fname = fname
+        self.json_fname = json_fname
+        # the database is created when it is accessed for the first time
+        self.initialized = False
+
+
+    def connect(self):
+
+        '''
+        Returns a connection to the database. Used as a context manager, the connection
+        commits the transaction on exit, or rolls it back if an exception was raised.
+        '''
+
+        if not self.initialized:
+            # the lock prevents two processes from importing the json file at the same time
+            with FileLock(self.fname):
+                migrate = (not os.path.isfile(self.fname)) and (self.json_fname is not None) and os.path.isfile(self.json_fname)
+                self.create_tables()
+                if migrate:
+                    try:
+                        self.import_json()
+                    except BaseException:
+                        # the database is removed, so that the import is tried again next time
+                        for f in [self.fname, self.fname + "-wal", self.fname + "-shm"]:
+                            if os.path.isfile(f):
+                                os.remove(f)
+                        raise
+                    os.replace(self.json_fname, self.json_fname + ".bak")
+            self.initialized = True
+        return sqlite3.connect(self.fname, timeout = 30)
+
+
+    def import_json(self):
+
+        con = sqlite3.connect(self.fname, timeout = 30)
+        with con:
+            self.run_statements(con, self.data_statements(JsonGradingState(self.json_fname, self.init_data).get_data()))
+        con.close()
+
+
+    def create_tables(self):
+
+        con = sqlite3.connect(self.fname, timeout = 30)
+        # in the write-ahead log mode readers are not blocked by a process writing to the database
+        con.execute("PRAGMA journal_mode=WAL")
+        with con:
+            con.execute("CREATE TABLE IF NOT EXISTS maxpoints (page TEXT PRIMARY KEY, points INTEGER)")
+            con.execute("CREATE TABLE IF NOT EXISTS processed_scans (fname TEXT PRIMARY KEY)")
+            con.execute("CREATE TABLE IF NOT EXISTS page_lists (fname TEXT, position INTEGER, page TEXT, PRIMARY KEY (fname, position))")
+            con.execute("CREATE INDEX IF NOT EXISTS page_lists_page ON page_lists (page)")
+            # missing data records are stored as json, with the file name and the page
+            # number as indexed columns
+            con.execute("CREATE TABLE IF NOT EXISTS missing_data (position INTEGER PRIMARY KEY, fname TEXT, page INTEGER, record TEXT)")
+            con.execute("CREATE INDEX IF NOT EXISTS missing_data_page ON missing_data (fname, page)")
+            con.execute("CREATE TABLE IF NOT EXISTS emails_sent (address TEXT PRIMARY KEY)")
+            con.execute("CREATE TABLE IF NOT EXISTS pnum_corrections (position INTEGER PRIMARY KEY, record TEXT)")
+            # scores are stored as json, since they can be integers or strings
+            con.execute("CREATE TABLE IF NOT EXISTS score_cache (fname TEXT, digest TEXT, score TEXT, PRIMARY KEY (fname, digest))")
+        con.close()
+
+
+    def execute(self, statements):
+
+        '''
+        Executes SQL statements in a single transaction.
+
+        :statements:
+            A list of tuples (sql, parameters), where parameters is a list of tuples
+            of parameters of the sql statement, one for each row it should be applied to.
+        '''
+
+        con = self.connect()
+        with con:
+            self.run_statements(con, statements)
+        con.close()
+
+
+    @staticmethod
+    def run_statements(con, statements):
+        for sql, params in statements:
+            con.executemany(sql, params)
+
+
+    def query(self, sql, params = ()):
+        con = self.connect()
+        rows = con.execute(sql, params).fetchall()
+        con.close()
+        return rows
+
+
+    def get_data(self):
+
+        data = {}
+        data["maxpoints"] = self.get_maxpoints()
+        data["processed_scans"] = self.get_processed_scans()
+        data["page_lists"] = self.get_page_lists()
+        data["missing_data"] = self.get_missing_data()
+        data["emails_sent"] = self.get_emails_sent()
+        data["pnum_corrections"] = self.get_pnum_corrections()
+        score_cache = {}
+        for fname, digest, score in self.query("SELECT fname, digest, score FROM score_cache"):
+            score_cache.setdefault(fname, {})[digest] = json.loads(score)
+        data["score_cache"] = score_cache
+        return data
+
+
+    def set_data(self, data):
+        self.execute(self.data_statements(data))
+
+
+    def data_statements(self, data):
+
+        data = dict(self.init_data, **data)
+        statements = [(f"DELETE FROM {table}", [()]) for table in
+                      ["maxpoints", "processed_scans", "page_lists", "missing_data", "emails_sent", "pnum_corrections", "score_cache"]]
+        statements += self.maxpoints_statements(data["maxpoints"])
+        statements += self.processed_scans_statements(data["processed_scans"])
+        for fname, pages in data["page_lists"].items():
+            statements += self.page_list_statements(fname, pages)
+        statements += self.missing_data_statements(data["missing_data"])
+        statements.append(("INSERT OR IGNORE INTO emails_sent VALUES (?)", [(a,) for a in data["emails_sent"]]))
+        statements += self.pnum_corrections_statements(data["pnum_corrections"])
+        for fname, scores in data["score_cache"].items():
+            statements += self.score_cache_statements(fname, scores)
+        return statements
+
+
+    def get_maxpoints(self):
+        return {page : points for page, points in self.query("SELECT page, points FROM maxpoints")}
+
+
+    def maxpoints_statements(self, maxpoints):
+        return [("INSERT OR REPLACE INTO maxpoints VALUES (?, ?)", [(str(k), v) for k, v in maxpoints.items()])]
+
+
+    def update_maxpoints(self, maxpoints):
+        self.execute(self.maxpoints_statements(maxpoints))
+
+
+    def get_processed_scans(self):
+        return [row[0] for row in self.query("SELECT fname FROM processed_scans ORDER BY rowid")]
+
+
+    def processed_scans_statements(self, fnames):
+        return [("INSERT OR IGNORE INTO processed_scans VALUES (?)", [(f,) for f in fnames])]
+
+
+    def add_processed_scans(self, fnames):
+        self.execute(self.processed_scans_statements(fnames))
+
+
+    def get_page_lists(self):
+        page_lists = {}
+        for fname, page in self.query("SELECT fname, page FROM page_lists ORDER BY fname, position"):
+            page_lists.setdefault(fname, []).append(page)
+        return page_lists
+
+
+    def page_list_statements(self, fname, pages):
+        return [("DELETE FROM page_lists WHERE fname = ?", [(fname,)]),
+                ("INSERT INTO page_lists VALUES (?, ?, ?)", [(fname, n, page) for n, page in enumerate(pages)])]
+
+
+    def set_page_list(self, fname, pages):
+        self.execute(self.page_list_statements(fname, pages))
+
+
+    def get_missing_data(self):
+        return [json.loads(row[0]) for row in self.query("SELECT record FROM missing_data ORDER BY position")]
+
+
+    def missing_data_statements(self, missing_data):
+        return [("DELETE FROM missing_data", [()]),
+                ("INSERT INTO missing_data VALUES (?, ?, ?, ?)",
+                 [(n, d.get("fname"), d.get("page"), json.dumps(d)) for n, d in enumerate(missing_data)])]
+
+
+    def set_missing_data(self, missing_data):
+
+        # rows of records which are in the new list in the same order are kept, other rows 
+        # are deleted, and the remaining records are inserted; the database is locked 
+        # from reading the rows until the changes are committed
+        con = self.connect()
+        con.isolation_level = None
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            rows = con.execute("SELECT position, record FROM missing_data ORDER BY position").fetchall()
+            keep = set()
+            new_records = []
+            k = 0
+            for d in missing_data:
+                record = json.dumps(d)
+                if len(new_records) == 0:
+                    while k < len(rows) and rows[k][1] != record:
+                        k += 1
+                    if k < len(rows):
+                        keep.add(rows[k][0])
+                        k += 1
+                        continue
+                new_records.append(d)
+            con.executemany("DELETE FROM missing_data WHERE position = ?", [(row[0],) for row in rows if row[0] not in keep])
+            self.run_statements(con, self.add_missing_data_statements(new_records))
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+
+    def add_missing_data_statements(self, records):
+        # positions of new rows are assigned by SQLite, following the last row
+        return [("INSERT INTO missing_data VALUES (NULL, ?, ?, ?)",
+                 [(d.get("fname"), d.get("page"), json.dumps(d)) for d in records])]
+
+
+    def add_missing_data(self, records):
+        self.execute(self.add_missing_data_statements(records))
+
+
+    def get_emails_sent(self):
+        return [row[0] for row in self.query("SELECT address FROM emails_sent ORDER BY rowid")]
+
+
+    def add_email_sent(self, address):
+        self.execute([("INSERT OR IGNORE INTO emails_sent VALUES (?)", [(address,)])])
+
+
+    def get_pnum_corrections(self):
+        return [json.loads(row[0]) for row in self.query("SELECT record FROM pnum_corrections ORDER BY position")]
+
+
+    def pnum_corrections_statements(self, corrections):
+        return [("INSERT INTO pnum_corrections (record) VALUES (?)", [(json.dumps(d),) for d in corrections])]
+
+
+    def add_pnum_corrections(self, corrections):
+        self.execute(self.pnum_corrections_statements(corrections))
+
+
+    def get_score_cache(self, fname):
+        return {digest : json.loads(score) for digest, score in
+                self.query("SELECT digest, score FROM score_cache WHERE fname = ?", (fname,))}
+
+
+    def score_cache_statements(self, fname, scores):
+        return [("DELETE FROM score_cache WHERE fname = ?", [(fname,)]),
+                ("INSERT INTO score_cache VALUES (?, ?, ?)", [(fname, d, json.dumps(score)) for d, score in scores.items()])]
+
+
+    def set_score_cache(self, fname, scores):
+        self.execute(self.score_cache_statements(fname, scores))
+
+
+
+def get_grading_state(main_dir, init_data, backend = "sqlite"):
+
+    '''
+    Returns an object giving access to grading data stored in the main grading directory.
+
+    :main_dir:
+        The main grading directory.
+    :init_data:
+        A dictionary with the initial structure of the grading data.
+    :backend:
+        The name of the backend, "sqlite" or "json". The "sqlite" backend stores
+        data in the grading_data.db file, and imports data from the grading_data.json
+        file used by the "json" backend, if this file exists.
+    '''
+
+    json_fname = os.path.join(main_dir, "grading_data.json")
+    if backend == "json":
+        return JsonGradingState(json_fname, init_data)
+    elif backend == "sqlite":
+        return SqliteGradingState(os.path.join(main_dir, "grading_data.db"), init_data, json_fname = json_fname)
+    else:
+        raise ValueError(f"Unknown grading data backend: {backend}")
@@ -1,13 +1,180 @@
 import io
+import hashlib
 import numpy as np
 import pdf2image
 import PyPDF2 as pdf
 import os
+import struct
+import time
 import pyzbar.pyzbar as pyz
 import cv2
 import shutil
+import subprocess
+from PIL import Image
 
-def pdfpage2img(pdf_page, dpi=200):
+
+def ccitt2img(data, width, height, k=0, black_is_1=False):
+
+    '''
+    Decodes CCITT fax encoded image data, by wrapping it into a minimal
+    TIFF file and reading this file with PIL.
+
+    :data:
+        Bytes with the encoded image data.
+    :width:
+    :height:
+        Dimensions of the image in pixels.
+    :k:
+        The value of the K parameter of the CCITTFaxDecode pdf filter:
+        negative for Group 4 encoding, 0 for Group 3 one-dimensional encoding,
+        positive for Group 3 two-dimensional encoding.
+    :black_is_1:
+        The value of the BlackIs1 parameter of the CCITTFaxDecode pdf filter.
+
+    Returns:
+        A numpy array with the RGB image.
+    '''
+
+    compression = 4 if k < 0 else 3
+    # the decoder outputs 1 for black runs; in a pdf the resulting sample values
+    # are interpreted in the gray color space, in which 0 is black unless
+    # black_is_1 is True; TIFF photometric interpretations: 0 = WhiteIsZero, 1 = BlackIsZero
+    photometric = 1 if black_is_1 else 0
+
+    # TIFF tags: (tag, type, count, value); type 3 is SHORT, type 4 is LONG
+    tags = [(256, 4, 1, width),
+            (257, 4, 1, height),
+            (258, 3, 1, 1),
+            (259, 3, 1, compression),
+            (262, 3, 1, photometric),
+            (273, 4, 1, 0),
+            (278, 4, 1, height),
+            (279, 4, 1, len(data))]
+    if compression == 3:
+        tags.append((292, 4, 1, 1 if k > 0 else 0))
+
+    # image data is placed right after the header and the image file directory
+    data_offset = 8 + 2 + 12*len(tags) + 4
+    tags = [(t, typ, n, data_offset if t == 273 else v) for (t, typ, n, v) in tags]
+    ifd = struct.pack("<H", len(tags))
+    ifd += b"".join(struct.pack("<HHII", *t) for t in tags)
+    ifd += struct.pack("<I", 0)
+    tiff = struct.pack("<2sHI", b"II", 42, 8) + ifd + data
+
+    return np.array(Image.open(io.BytesIO(tiff)).convert("RGB"))
+
+
+def extract_page_image(page):
+
+    '''
+    Extracts the image from a pdf page which consists of a single embedded image
+    covering the whole page, as pages of scanned pdf files usually do. The image
+    stream is decoded directly, without rendering the page, and so the image is
+    obtained at the native resolution of the scanner.
+
+    :page:
+        A PyPDF2 PageObject.
+
+    Returns:
+        A numpy array with the RGB image of the page, or None if the page does not
+        consist of a single image in a supported format. Such pages need to be
+        rendered instead.
+    '''
+
+    try:
+        resources = page["/Resources"].getObject()
+        xobjects = resources.get("/XObject", pdf.generic.DictionaryObject()).getObject()
+        if len(xobjects) != 1:
+            return None
+        xobj = list(xobjects.values())[0].getObject()
+        if xobj.get("/Subtype") != "/Image" or getattr(xobj.get("/ImageMask"), "value", False):
+            return None
+
+        # the page content can only draw the image, and the image must be upright
+        # and cover the whole page
+        ctm = [1, 0, 0, 1, 0, 0]
+        stack = []
+        draws = []
+        content = pdf.pdf.ContentStream(page.getContents(), page.pdf)
+        for operands, operator in content.operations:
+            if isinstance(operator, bytes):
+                operator = operator.decode("latin-1")
+            if operator == "q":
+                stack.append(ctm)
+            elif operator == "Q":
+                ctm = stack.pop()
+            elif operator == "cm":
+                a, b, c, d, e, f = [float(x) for x in operands]
+                A, B, C, D, E, F = ctm
+                ctm = [a*A + b*C, a*B + b*D, c*A + d*C, c*B + d*D, e*A + f*C + E, e*B + f*D + F]
+            elif operator == "Do":
+                draws.append(ctm)
+            else:
+                return None
+        if len(draws) != 1:
+            return None
+        a, b, c, d, e, f = draws[0]
+        box = page.mediaBox
+        page_w = float(box.getWidth())
+        page_h = float(box.getHeight())
+        if b != 0 or c != 0 or a < 0.95*page_w or d < 0.95*page_h:
+            return None
+
+        filters = xobj.get("/Filter", [])
+        if not isinstance(filters, list):
+            filters = [filters]
+        filters = [f.getObject() for f in filters]
+        params = xobj.get("/DecodeParms", pdf.generic.DictionaryObject())
+        if isinstance(params, list):
+            params = params[-1] if len(params) > 0 else None
+        params = pdf.generic.DictionaryObject() if params is None else params.getObject()
+
+        colorspace = xobj.get("/ColorSpace")
+        colorspace = colorspace.getObject() if colorspace is not None else None
+        if isinstance(colorspace, list) and colorspace[0] == "/ICCBased":
+            colorspace = {1: "/DeviceGray", 3: "/DeviceRGB"}.get(colorspace[1].getObject().get("/N"))
+        width = int(xobj["/Width"])
+        height = int(xobj["/Height"])
+
+        if filters == ["/CCITTFaxDecode"]:
+            img = ccitt2img(xobj._data,
+                            width = int(params.get("/Columns", 1728)),
+                            height = int(params.get("/Rows", height)),
+                            k = int(params.get("/K", 0)),
+                            black_is_1 = getattr(params.get("/BlackIs1"), "value", False))
+            if list(xobj.get("/Decode", [0, 1])) == [1, 0]:
+                img = 255 - img
+        elif "/Decode" in xobj:
+            return None
+        elif filters in [["/DCTDecode"], ["/JPXDecode"]]:
+            if colorspace not in ["/DeviceGray", "/DeviceRGB", None]:
+                return None
+            img = cv2.imdecode(np.frombuffer(xobj._data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                return None
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        elif filters in [[], ["/FlateDecode"]] and int(xobj.get("/BitsPerComponent", 0)) == 8:
+            channels = {"/DeviceGray": 1, "/DeviceRGB": 3}.get(colorspace)
+            if channels is None:
+                return None
+            img = np.frombuffer(xobj.getData(), dtype=np.uint8)[:width*height*channels]
+            img = img.reshape(height, width, channels)
+            if channels == 1:
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+        else:
+            return None
+    except Exception:
+        return None
+
+    # apply the rotation of the page; the /Rotate angle is clockwise
+    try:
+        rot = int(page.get("/Rotate", 0)) % 360
+    except:
+        rot = 0
+    return rotate_img(img, rot)
+
+
+def pdfpage2img(pdf_page, dpi=200, extract_images=True):
 
     '''
     Converts a single pdf page into an image.
@@ -15,11 +182,20 @@ def pdfpage2img(pdf_page, dpi=200):
         A PdfFileWriter object.
     :dpi:
         Resolution of the image produced from the pdf.
+    :extract_images:
+        Boolean. If True and the page consists of a single embedded image (as scanned
+        pages do), the image is decoded directly and returned at its native resolution,
+        instead of rendering the page with the resolution given by dpi.
 
     Returns:
         A numpy array with the image.
     '''
 
+    if extract_images:
+        page_image = extract_page_image(pdf_page.getPage(0))
+        if page_image is not None:
+            return page_image
+
     pdf_bytes = io.BytesIO()
     pdf_page.write(pdf_bytes)
     pdf_bytes.seek(0)
@@ -29,6 +205,221 @@ def pdfpage2img(pdf_page, dpi=200):
     return page_image
 
 
+def pdf2imgs(fname, first_page=1, last_page=None, dpi=200, chunk_size=10, extract_images=True):
+
+    '''
+    Converts pages of a pdf file into images. Pages are rendered in batches,
+    with a single poppler call for each batch, so the cost of starting poppler
+    and serializing pdf pages is not incurred for every page separately.
+
+    :fname:
+        Name of the pdf file.
+    :first_page:
+    :last_page:
+        Numbers of the first and the last page to be converted (pages are
+        numbered starting with 1). If last_page is None, pages will be converted
+        until the end of the file.
+    :dpi:
+        Resolution of the images produced from the pdf.
+    :chunk_size:
+        The number of pages rendered in one batch. This also bounds the number of
+        page images kept in memory at the same time.
+    :extract_images:
+        Boolean. If True, images of pages consisting of a single embedded image
+        (as scanned pages do) are decoded directly from the pdf file at their native
+        resolution, and only the remaining pages are rendered.
+
+    Returns:
+        A generator yielding numpy arrays with images of consecutive pages.
+    '''
+
+    with open(fname, 'rb') as f:
+        reader = pdf.PdfFileReader(f)
+        if last_page is None:
+            last_page = reader.numPages
+
+        for first in range(first_page, last_page + 1, chunk_size):
+            last = min(first + chunk_size - 1, last_page)
+
+            # decode pages consisting of a single image
+            images = {}
+            if extract_images:
+                for n in range(first, last + 1):
+                    page_image = extract_page_image(reader.getPage(n-1))
+                    if page_image is not None:
+                        images[n] = page_image
+
+            # render the remaining pages in a single batch
+            to_render = [n for n in range(first, last + 1) if n not in images]
+            if len(to_render) > 0:
+                rendered = pdf2image.convert_from_path(fname, dpi = dpi, first_page = to_render[0], last_page = to_render[-1])
+                for n, page_image in zip(range(to_render[0], to_render[-1] + 1), rendered):
+                    if n not in images:
+                        images[n] = np.array(page_image)
+
+            for n in range(first, last + 1):
+                yield images.pop(n)
+
+
+def read_ppm(stream):
+
+    '''
+    Reads a single image in the binary PPM format (as produced by pdftoppm) from a stream.
+
+    :stream:
+        A binary file object.
+
+    Returns:
+        A numpy array with the RGB image, or None if the stream is exhausted.
+    '''
+
+    # the header consists of the magic number, width, height and the maximal value,
+    # separated by whitespace, possibly with comments
+    tokens = []
+    token = b""
+    while len(tokens) < 4:
+        c = stream.read(1)
+        if c == b"":
+            return None
+        if c == b"#":
+            stream.readline()
+        elif c.isspace():
+            if token != b"":
+                tokens.append(token)
+                token = b""
+        else:
+            token += c
+    if tokens[0] != b"P6" or int(tokens[3]) > 255:
+        raise ValueError("Unsupported PPM image format.")
+    width, height = int(tokens[1]), int(tokens[2])
+    data = stream.read(width*height*3)
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+
+
+def pdf2crops(fname, x, y, width, height, first_page=1, last_page=None, dpi=200):
+
+    '''
+    Renders a rectangular region of pages of a pdf file. Only the region is rendered,
+    using the cropping options of poppler's pdftoppm, and pages are read from its
+    output one at a time, so that only the image of the current page is kept 
+    in memory. 
+
+    :fname:
+        Name of the pdf file.
+    :x:
+    :y:
+        Coordinates of the upper left corner of the region, in pixels of the page image 
+        with the given resolution, measured from the upper left corner of the page.
+    :width:
+    :height:
+        Width and height of the region in pixels.
+    :first_page:
+    :last_page:
+        Numbers of the first and the last page to be converted (pages are
+        numbered starting with 1). If last_page is None, pages will be converted
+        until the end of the file.
+    :dpi:
+        Resolution of the images.
+
+    Returns:
+        A generator yielding numpy arrays with RGB images of the region on consecutive pages.
+    '''
+
+    if last_page is None:
+        with open(fname, 'rb') as f:
+            last_page = pdf.PdfFileReader(f).numPages
+    if last_page < first_page:
+        return
+
+    cmd = ["pdftoppm", "-r", str(dpi), "-f", str(first_page), "-l", str(last_page),
+           "-x", str(x), "-y", str(y), "-W", str(width), "-H", str(height), fname]
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        # pdf2image uses the same program, so there is nothing to fall back on
+        raise FileNotFoundError("pdftoppm not found: poppler must be installed and on PATH to render pdf pages")
+
+    try:
+        for n in range(first_page, last_page + 1):
+            img = read_ppm(proc.stdout)
+            if img is None:
+                raise RuntimeError(f"pdftoppm failed to render page {n} of {fname}")
+            yield img
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def box_means(imgs, boxes):
+
+    '''
+    Computes mean pixel values of rectangular regions of images. 
+
+    :imgs:
+        A numpy array of shape (pages, height, width) or (pages, height, width, channels)
+        with images of the same size.
+    :boxes:
+        A list of rectangles (left, top, width, height), in pixels.
+
+    Returns:
+        A numpy array of shape (pages, boxes) with the mean pixel value of each 
+        rectangle in each image. 
+    '''
+
+    imgs = np.asarray(imgs)
+    channels = 1
+    if imgs.ndim == 4:
+        channels = imgs.shape[3]
+        imgs = imgs.sum(axis = 3, dtype = np.int64)
+    # summed area table: integral[:, i, j] is the sum of pixels above and to the left of (i, j)
+    integral = np.zeros((imgs.shape[0], imgs.shape[1] + 1, imgs.shape[2] + 1), dtype = np.int64)
+    integral[:, 1:, 1:] = imgs.cumsum(axis = 1, dtype = np.int64).cumsum(axis = 2)
+
+    x0, y0, w, h = np.array(boxes, dtype = int).reshape(-1, 4).T
+    x1, y1 = x0 + w, y0 + h
+    sums = integral[:, y1, x1] - integral[:, y0, x1] - integral[:, y1, x0] + integral[:, y0, x0]
+    return sums/(w*h*channels)
+
+
+def otsu_treshold(values, bins = 256, value_range = (0, 255)):
+
+    '''
+    Computes the Otsu treshold splitting values into two classes, 
+    so that the variance within the classes is minimal.
+
+    :values:
+        An array of values.
+    :bins:
+        The number of histogram bins used to compute the treshold.
+    :value_range:
+        A tuple with the range of values. 
+
+    Returns:
+        A tuple (treshold, low_mean, high_mean), where low_mean and high_mean
+        are means of values below and above the treshold. If all values are 
+        in the same histogram bin, None is returned. 
+    '''
+
+    hist, edges = np.histogram(np.ravel(values), bins = bins, range = value_range)
+    centers = 0.5*(edges[:-1] + edges[1:])
+    # weights and sums of values of the class below each bin edge
+    w0 = np.cumsum(hist)[:-1]
+    s0 = np.cumsum(hist*centers)[:-1]
+    w1 = hist.sum() - w0
+    s1 = (hist*centers).sum() - s0
+    valid = (w0 > 0) & (w1 > 0)
+    if not valid.any():
+        return None
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        m0 = s0/w0
+        m1 = s1/w1
+        between = np.where(valid, w0*w1*(m0 - m1)**2, -1)
+    # empty bins between the classes give several maxima, use the middle one
+    maxima = np.flatnonzero(between == between.max())
+    k = maxima[len(maxima)//2]
+    return edges[k + 1], m0[k], m1[k]
+
+
 def extract_pages(inputpdf, fpage, lpage):
 
     '''
@@ -125,12 +516,613 @@ def merge_pdfs(files, output_fname="merged.pdf"):
     output.close()
 
 
-def enhanced_qr_decode(img, xmax=5, ymax=5):
+def insert_pages(fname, pages, positions):
+    '''
+    Inserts pages into a pdf file using an incremental update: new objects 
+    and a new cross-reference section are appended at the end of the file, 
+    while the existing content of the file, including annotations of its 
+    pages, is preserved byte for byte.
+
+    :fname:
+        Name of the pdf file. 
+    :pages:
+        A list of PyPDF2 PageObjects to be inserted. 
+    :positions:
+        A list of indices of the inserted pages in the updated file, 
+        in the increasing order. 
+
+    Returns:
+        None
+    '''
+
+    with open(fname, 'rb') as f:
+        reader = pdf.PdfFileReader(f)
+        old_pages = [reader.getPage(n) for n in range(reader.numPages)]
+        if len(positions) != len(pages):
+            raise ValueError(f"{len(pages)} pages to insert into {fname}, but {len(positions)} positions given")
+        if any(a >= b for a, b in zip(positions, positions[1:])) or \
+           (len(positions) > 0 and (positions[0] < 0 or positions[-1] >= len(old_pages) + len(pages))):
+            raise ValueError(f"Invalid positions of pages inserted into {fname}: {positions}")
+        pages_ref = reader.trailer["/Root"].raw_get("/Pages")
+        pages_root = pages_ref.getObject()
+        trailer = reader.trailer
+        size = trailer["/Size"]
+
+        # offset of the last cross-reference section of the file
+        f.seek(max(0, os.path.getsize(fname) - 1024))
+        tail = f.read()
+        prev = int(tail[tail.rindex(b"startxref") + 9:].split()[0])
+
+        # a writer collects the new pages together with all objects they refer to;
+        # its list of objects is padded, so that these objects are numbered starting 
+        # with the first object number unused in the file
+        writer = pdf.PdfFileWriter()
+        writer._objects.extend([None]*(size - 1 - len(writer._objects)))
+        for page in pages:
+            writer.addPage(page)
+        # references to the new pages (e.g. in annotations) point to their copies
+        # in the writer, as in PdfFileWriter.write
+        extern_map = {}
+        for idnum, page in enumerate(writer._objects, start = 1):
+            if isinstance(page, pdf.pdf.PageObject) and page.indirectRef is not None:
+                ref = page.indirectRef
+                extern_map.setdefault(ref.pdf, {}).setdefault(ref.generation, {})[ref.idnum] = pdf.generic.IndirectObject(idnum, 0, writer)
+        writer.stack = []
+        writer._sweepIndirectReferences(extern_map, writer._pages)
+        new_refs = [pdf.generic.IndirectObject(size + n, 0, writer) for n in range(len(pages))]
+
+        # objects to be appended: new objects, and updated versions of the page tree
+        # and of pages which will be moved from nested nodes of the page tree to its root
+        updated = {}
+        for idnum in range(size, len(writer._objects) + 1):
+            updated[(idnum, 0)] = writer._objects[idnum - 1]
+        for ref in new_refs:
+            updated[(ref.idnum, 0)][pdf.generic.NameObject("/Parent")] = pages_ref
+
+        kids = pdf.generic.ArrayObject()
+        old = iter(old_pages)
+        new = iter(new_refs)
+        for n in range(len(old_pages) + len(pages)):
+            if n in positions:
+                kids.append(next(new))
+            else:
+                page = next(old)
+                kids.append(page.indirectRef)
+                # pages inherit attributes of their parents, the page object returned by 
+                # the reader includes them
+                if page.raw_get("/Parent") != pages_ref:
+                    page[pdf.generic.NameObject("/Parent")] = pages_ref
+                    updated[(page.indirectRef.idnum, page.indirectRef.generation)] = page
+
+        root = pdf.generic.DictionaryObject()
+        for key in pages_root:
+            root[pdf.generic.NameObject(key)] = pages_root.raw_get(key)
+        root[pdf.generic.NameObject("/Kids")] = kids
+        root[pdf.generic.NameObject("/Count")] = pdf.generic.NumberObject(len(kids))
+        updated[(pages_ref.idnum, pages_ref.generation)] = root
+
+        new_size = max(size, len(writer._objects) + 1)
+        new_trailer = pdf.generic.DictionaryObject()
+        for key in ["/Root", "/Info", "/ID"]:
+            if key in trailer:
+                new_trailer[pdf.generic.NameObject(key)] = trailer.raw_get(key)
+        new_trailer[pdf.generic.NameObject("/Size")] = pdf.generic.NumberObject(new_size)
+        new_trailer[pdf.generic.NameObject("/Prev")] = pdf.generic.NumberObject(prev)
+
+        # serialize updated objects
+        out = io.BytesIO()
+        offset = os.path.getsize(fname) + 1
+        offsets = {}
+        for (idnum, generation), obj in sorted(updated.items()):
+            offsets[idnum] = (offset + out.tell(), generation)
+            out.write(b"%d %d obj\n" % (idnum, generation))
+            obj.writeToStream(out, None)
+            out.write(b"\nendobj\n")
+
+    # append the objects and the cross-reference section to the file
+    with open(fname, 'ab') as f:
+        f.write(b"\n")
+        f.write(out.getvalue())
+        xref = offset + out.tell()
+        f.write(b"xref\n0 1\n0000000000 65535 f \n")
+        ids = sorted(offsets)
+        start = 0
+        while start < len(ids):
+            end = start
+            while end + 1 < len(ids) and ids[end + 1] == ids[end] + 1:
+                end += 1
+            f.write(b"%d %d\n" % (ids[start], end - start + 1))
+            for idnum in ids[start:end + 1]:
+                f.write(b"%010d %05d n \n" % offsets[idnum])
+            start = end + 1
+        f.write(b"trailer\n")
+        new_trailer.writeToStream(f, None)
+        f.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref)
+
+
+class PdfStreamWriter():
+
+    '''
+    Writes pages to a pdf file as they are added, so that a large file can be 
+    produced without holding all its pages in memory. Objects the pages refer to
+    are copied to the file once, and then are shared by all pages referring to them 
+    (e.g. form xobjects or fonts used on many pages). Unlike PdfFileWriter, 
+    the writer does not modify objects it copies, so the same objects can be 
+    added to several files.
+    '''
+
+    def __init__(self, fname, info = None):
+
+        '''
+        :fname:
+            Name of the pdf file. 
+        :info:
+            A dictionary with entries of the document information dictionary
+            of the file, e.g. {"/Title" : "Exam"}. Values should be strings.
+        '''
+
+        self.info = info
+
+        self.file = open(fname, 'wb')
+        self.file.write(b"%PDF-1.3\n%\xe2\xe3\xcf\xd3\n")
+        # object numbers of the page tree root and of the document catalog
+        self.pages_ref = pdf.generic.IndirectObject(1, 0, self)
+        self.root_ref = pdf.generic.IndirectObject(2, 0, self)
+        self.offsets = {}
+        self.next_idnum = 3
+        self.kids = pdf.generic.ArrayObject()
+        # references to copies of objects, keyed by pdf files they come from
+        self.refs = {}
+        self.pending = []
+
+
+    def add_page(self, page):
+
+        '''
+        Adds a page at the end of the file. 
+
+        :page:
+            A PyPDF2 PageObject or a dictionary object with the page. Attributes 
+            inherited from the page tree should be included in the page.
+        '''
+
+        copy = self.copy_object(page, exclude = ["/Parent", "/Annots"])
+        copy[pdf.generic.NameObject("/Parent")] = self.pages_ref
+        if "/Annots" in page:
+            # references to pages from annotations are omitted, since they would
+            # pull the page tree of the source file into the output file
+            annots = pdf.generic.ArrayObject()
+            for annot in page["/Annots"]:
+                annot_copy = self.copy_object(annot.getObject(), exclude = ["/P"])
+                annots.append(self.add_object(annot_copy))
+            copy[pdf.generic.NameObject("/Annots")] = annots
+        self.kids.append(self.add_object(copy))
+        self.flush()
+
+
+    def release(self, source):
+
+        '''
+        Forgets copies of objects from a given pdf file, so that they will be 
+        copied again if needed. Should be used when no more pages 
+        from the file will be added.
+
+        :source:
+            A PyPDF2 PdfFileReader or PdfFileWriter object. 
+        '''
+
+        self.refs.pop(source, None)
+
+
+    def add_object(self, obj):
+
+        idnum = self.next_idnum
+        self.next_idnum += 1
+        self.pending.append((idnum, obj))
+        return pdf.generic.IndirectObject(idnum, 0, self)
+
+
+    def copy_object(self, obj, exclude = []):
+
+        '''
+        Returns a copy of a pdf object with references to objects from other 
+        pdf files replaced by references to their copies in this file. 
+        '''
+
+        if isinstance(obj, pdf.generic.IndirectObject):
+            if obj.pdf is self:
+                return obj
+            refs = self.refs.setdefault(obj.pdf, {})
+            key = (obj.idnum, obj.generation)
+            if key not in refs:
+                idnum = self.next_idnum
+                self.next_idnum += 1
+                refs[key] = pdf.generic.IndirectObject(idnum, 0, self)
+                # objects are written after their copies are complete
+                copy = self.copy_object(obj.getObject())
+                self.pending.append((idnum, copy))
+            return refs[key]
+
+        elif isinstance(obj, pdf.generic.DictionaryObject):
+            if isinstance(obj, pdf.generic.EncodedStreamObject):
+                copy = pdf.generic.EncodedStreamObject()
+                copy._data = obj._data
+            elif isinstance(obj, pdf.generic.StreamObject):
+                copy = pdf.generic.DecodedStreamObject()
+                copy.setData(obj.getData())
+            else:
+                copy = pdf.generic.DictionaryObject()
+            for key, value in obj.items():
+                # stream lengths are computed when streams are written
+                if key in exclude or (key == "/Length" and isinstance(copy, pdf.generic.StreamObject)):
+                    continue
+                value = self.copy_object(value)
+                # streams can be included in the file only as indirect objects
+                if isinstance(value, pdf.generic.StreamObject):
+                    value = self.add_object(value)
+                copy[pdf.generic.NameObject(key)] = value
+            return copy
+
+        elif isinstance(obj, pdf.generic.ArrayObject):
+            copy = pdf.generic.ArrayObject()
+            for value in obj:
+                value = self.copy_object(value)
+                if isinstance(value, pdf.generic.StreamObject):
+                    value = self.add_object(value)
+                copy.append(value)
+            return copy
+
+        else:
+            return obj
+
+
+    def flush(self):
+
+        for idnum, obj in sorted(self.pending):
+            self.write_object(idnum, obj)
+        self.pending = []
+
+
+    def write_object(self, idnum, obj):
+
+        self.offsets[idnum] = self.file.tell()
+        self.file.write(b"%d 0 obj\n" % idnum)
+        obj.writeToStream(self.file, None)
+        self.file.write(b"\nendobj\n")
+
+
+    def close(self):
+
+        '''
+        Writes the page tree, the cross-reference table and the trailer, 
+        and closes the file. 
+        '''
+
+        self.flush()
+        pages = pdf.generic.DictionaryObject()
+        pages[pdf.generic.NameObject("/Type")] = pdf.generic.NameObject("/Pages")
+        pages[pdf.generic.NameObject("/Kids")] = self.kids
+        pages[pdf.generic.NameObject("/Count")] = pdf.generic.NumberObject(len(self.kids))
+        self.write_object(self.pages_ref.idnum, pages)
+
+        root = pdf.generic.DictionaryObject()
+        root[pdf.generic.NameObject("/Type")] = pdf.generic.NameObject("/Catalog")
+        root[pdf.generic.NameObject("/Pages")] = self.pages_ref
+        self.write_object(self.root_ref.idnum, root)
+
+        info_ref = None
+        if self.info is not None:
+            info = pdf.generic.DictionaryObject()
+            for key, value in self.info.items():
+                info[pdf.generic.NameObject(key)] = pdf.generic.createStringObject(value)
+            info_ref = self.add_object(info)
+            self.flush()
+
+        xref = self.file.tell()
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_idnum)
+        for idnum in range(1, self.next_idnum):
+            self.file.write(b"%010d 00000 n \n" % self.offsets[idnum])
+        trailer = pdf.generic.DictionaryObject()
+        trailer[pdf.generic.NameObject("/Size")] = pdf.generic.NumberObject(self.next_idnum)
+        trailer[pdf.generic.NameObject("/Root")] = self.root_ref
+        if info_ref is not None:
+            trailer[pdf.generic.NameObject("/Info")] = info_ref
+        self.file.write(b"trailer\n")
+        trailer.writeToStream(self.file, None)
+        self.file.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref)
+        self.file.close()
+
+
+
+def page_digest(page, extra = "", memo = None):
+
+    '''
+    Computes a hash of the content of a pdf page: its content streams, resources,
+    annotations and page attributes, with all objects they refer to. Pages which 
+    have the same digest look the same. 
+
+    :page:
+        A PyPDF2 PageObject.
+    :extra:
+        A string included in the hash, e.g. with parameters of the computation
+        which depends on the page content. 
+    :memo:
+        A dictionary storing hashes of indirect objects. Objects shared by pages
+        of the same file are hashed once if the same dictionary is used for all pages.
+
+    Returns:
+        A string with the hexadecimal digest.
+    '''
+
+    if memo is None:
+        memo = {}
+
+    def digest(obj):
+        h = hashlib.sha256()
+        if isinstance(obj, pdf.generic.IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key not in memo:
+                # placeholder for reference cycles
+                memo[key] = b"cycle"
+                memo[key] = digest(obj.getObject())
+            return memo[key]
+        elif isinstance(obj, pdf.generic.DictionaryObject):
+            h.update(b"dict")
+            # references to parent objects would include the whole document
+            for k in sorted(obj.keys()):
+                if k in ["/Parent", "/P"]:
+                    continue
+                h.update(k.encode() + digest(obj.raw_get(k)))
+            if isinstance(obj, pdf.generic.StreamObject):
+                h.update(b"stream" + obj._data)
+        elif isinstance(obj, pdf.generic.ArrayObject):
+            h.update(b"array")
+            for item in obj:
+                h.update(digest(item))
+        else:
+            h.update(type(obj).__name__.encode() + repr(obj).encode())
+        return h.digest()
+
+    h = hashlib.sha256(extra.encode())
+    for key in ["/Contents", "/Resources", "/Annots", "/Rotate", "/MediaBox", "/CropBox"]:
+        # inherited attributes are included
+        h.update(key.encode() + digest(page.get(key)))
+    return h.hexdigest()
+
+
+def qr_regions(img, size=0.4, dpi=200):
+
+    '''
+    Selects regions of an image of an exam page where a QR code is expected to be found.
+    On an unrotated page the QR code is located in the upper right corner; on rotated
+    pages it can be found in one of the remaining corners.
+
+    :img:
+        A numpy array encoding the image.
+    :size:
+        The size of a corner region, as a fraction of the shorter side of the image.
+    :dpi:
+        Resolution to which regions are scaled down if the resolution of the image is
+        higher. A QR code printed by make_exams is then about 200 pixels wide, regardless
+        of the resolution of the scan.
+
+    Returns:
+        A list of tuples (region, top, left, scale) where region is a numpy array with the 
+        image of the corner region, top and left are coordinates of the upper left corner 
+        of the region in the image, and scale is the factor by which the region was resized. 
+        Corners are listed in the order: upper right, upper left, lower left, lower right.
+    '''
+
+    h, w, *_ = img.shape
+    s = int(size*min(h, w))
+    # resolution of the image, assuming that the shorter side of the page is 8.5 inches
+    scale = min(1, dpi/(min(h, w)/8.5))
+
+    regions = []
+    for top, left in [(0, w-s), (0, 0), (h-s, 0), (h-s, w-s)]:
+        region = img[top:top+s, left:left+s]
+        if scale < 1:
+            region = cv2.resize(region, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        regions.append((region, top, left, scale))
+    return regions
+
+
+def shift_qr(qr_list, top, left, scale):
+
+    '''
+    Converts locations of QR codes found in a region of an image to coordinates of the
+    whole image.
+
+    :qr_list:
+        A list of pyzbar objects with decoded QR codes.
+    :top:
+    :left:
+    :scale:
+        Position and scale of the region, as returned by qr_regions.
+
+    Returns:
+        A list of pyzbar objects with adjusted locations of QR codes.
+    '''
+
+    shifted = []
+    for q in qr_list:
+        rect = q.rect._replace(left = int(q.rect.left/scale) + left,
+                               top = int(q.rect.top/scale) + top,
+                               width = int(q.rect.width/scale),
+                               height = int(q.rect.height/scale))
+        polygon = [p._replace(x = int(p.x/scale) + left, y = int(p.y/scale) + top) for p in q.polygon]
+        shifted.append(q._replace(rect = rect, polygon = polygon))
+    return shifted
+
+
+class QRDecoder():
+
+    '''
+    Decoder of QR codes on exam pages, which can recover QR codes from noisy images.
+    If a QR code is not found in the original image, the decoder tries progressively
+    more expensive image transformations: adaptive thresholding, downscaling, and
+    finally a series of morphological openings and closures with various kernel sizes.
+    The decoder records which transformations succeeded, and tries the most successful
+    ones first on subsequent images.
+    '''
+
+    def __init__(self, xmax=5, ymax=5, roi=True, corner_kernels=4):
+
+        '''
+        :xmax:
+        :ymax:
+            Maximal dimensions of kernels used to compute openings and closures of images.
+        :roi:
+            Boolean. If True, QR codes are first searched for only in corners of the image,
+            where make_exams places QR codes (see qr_regions). The whole image is searched
+            only if no QR code is found in any of the corners.
+        :corner_kernels:
+            The number of kernels used to compute openings and closures of corners of the image.
+            The most successful kernels are used; all kernels are tried on the whole image. 
+            This bounds the time spent on images without a readable QR code.
+        '''
+
+        self.roi = roi
+        self.corner_kernels = corner_kernels
+        # morphological operations, in the order in which they are tried initially
+        self.kernels = [(op, i, j) for i in range(1, xmax+1) for j in range(1, ymax+1) for op in ["open", "close"]]
+        # the number of times each kernel and each image region (corners followed by the whole image)
+        # led to a successful decoding
+        self.kernel_successes = {k: 0 for k in self.kernels}
+        self.region_successes = [0]*5
+
+        # recovery statistics: the number of processed images, the number of images decoded by each
+        # method, the number of images where decoding failed or exceeded the time budget, the total
+        # number of calls to the zbar decoder and the total decoding time in seconds
+        self.stats = {"images": 0, "direct": 0, "adaptive": 0, "pyramid": 0, "morphology": 0,
+                      "failed": 0, "timeouts": 0, "decodes": 0, "time": 0.0}
+        # the method which decoded the last image, None if decoding failed
+        self.last_method = None
+
+
+    def zbar_decode(self, img):
+        self.stats["decodes"] += 1
+        return pyz.decode(img, symbols=[pyz.ZBarSymbol.QRCODE]) # look for QR codes only
+
+
+    def candidates(self, regions):
+
+        '''
+        A generator yielding images to be decoded, in the order in which they should be tried.
+
+        :regions:
+            A list of tuples (region, top, left, scale, n), where the first four entries
+            are as returned by qr_regions, and n is the index of the region.
+
+        Yields:
+            Tuples (method, image, region) where method is a string describing the image
+            transformation, image is the transformed image, and region is the entry of regions
+            the image comes from.
+        '''
+
+        # regions which were successful before are tried first; the whole image comes last
+        corners = sorted(regions[:-1], key = lambda r: -self.region_successes[r[4]])
+        regions = corners + regions[-1:]
+
+        for r in regions:
+            yield "direct", r[0], r
+
+        gray = {r[4]: cv2.cvtColor(r[0], cv2.COLOR_BGR2GRAY) for r in regions}
+
+        for r in regions:
+            adaptive = cv2.adaptiveThreshold(gray[r[4]], 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 51, 10)
+            yield "adaptive", adaptive, r
+
+        for r in regions:
+            yield "pyramid", cv2.pyrDown(gray[r[4]]), r
+
+        kernels = sorted(self.kernels, key = lambda k: -self.kernel_successes[k])
+        thresh = {n: cv2.threshold(g, 200, 255, cv2.THRESH_BINARY_INV)[1] for n, g in gray.items()}
+        for group, group_kernels in [(corners, kernels[:self.corner_kernels]), (regions[-1:], kernels)]:
+            for op, i, j in group_kernels:
+                for r in group:
+                    morph = cv2.MORPH_OPEN if op == "open" else cv2.MORPH_CLOSE
+                    transformed = cv2.bitwise_not(cv2.morphologyEx(thresh[r[4]], morph, np.ones((i, j))))
+                    yield (op, i, j), transformed, r
+
+
+    def decode(self, img, time_budget=None):
+
+        '''
+        Decodes QR codes in an image.
+
+        :img:
+            A numpy array encoding the image.
+            Note: matrix entries must be unsigned integers in the range 0-255
+        :time_budget:
+            The maximal time in seconds spent on decoding the image. If None, all image 
+            transformations will be tried if needed. 
+
+        Returns:
+            A list of pyzbar objects with decoded QR codes. The list is empty if no codes
+            were found. Locations of QR codes are given in coordinates of the whole image.
+        '''
+
+        start = time.perf_counter()
+        self.stats["images"] += 1
+        self.last_method = None
+
+        regions = qr_regions(img) if self.roi else []
+        regions.append((img, 0, 0, 1))
+        regions = [r + (n,) for n, r in enumerate(regions)]
+
+        qr = []
+        for method, image, r in self.candidates(regions):
+            if time_budget is not None and time.perf_counter() - start > time_budget:
+                self.stats["timeouts"] += 1
+                break
+            qr = self.zbar_decode(image)
+            if len(qr) != 0:
+                region, top, left, scale, n = r
+                # decoded images of downscaled regions are half of the size of the region
+                if method == "pyramid":
+                    scale = scale*image.shape[0]/region.shape[0]
+                qr = shift_qr(qr, top, left, scale)
+                self.region_successes[n] += 1
+                if isinstance(method, tuple):
+                    self.kernel_successes[method] += 1
+                    self.stats["morphology"] += 1
+                    self.last_method = "{} {}x{}".format(*method)
+                else:
+                    self.stats[method] += 1
+                    self.last_method = method
+                break
+
+        if len(qr) == 0:
+            self.stats["failed"] += 1
+        self.stats["time"] += time.perf_counter() - start
+        return qr
+
+
+# decoders used by enhanced_qr_decode; they are kept for the lifetime of the process,
+# so that their record of successful image transformations carries over between pages
+qr_decoders = {}
+
+def get_qr_decoder(xmax=5, ymax=5, roi=True):
+
+    '''
+    Returns the QRDecoder object with given parameters used by enhanced_qr_decode.
+    Its stats attribute contains recovery statistics of QR codes decoded so far. 
+    '''
+
+    key = (xmax, ymax, roi)
+    if key not in qr_decoders:
+        qr_decoders[key] = QRDecoder(xmax = xmax, ymax = ymax, roi = roi)
+    return qr_decoders[key]
+
+
+def enhanced_qr_decode(img, xmax=5, ymax=5, roi=True, time_budget=None):
     '''
     Enhanced decoder of QR codes. Can help with reading QR codes in noisy images.
-    If a QR code is not found in the original image, the function performs a series
-    of morphological openings and closures on the image with various parametries in
-    an attempty to enhance the QR code.
+    If a QR code is not found in the original image, the function tries a series 
+    of image transformations (adaptive thresholding, downscaling, morphological openings 
+    and closures with various parameters) in an attempt to enhance the QR code. 
+    See QRDecoder for details.
 
     :img:
         A numpy array encoding the image.
@@ -138,31 +1130,56 @@ def enhanced_qr_decode(img, xmax=5, ymax=5):
     :xmax:
     :ymax:
         Maximal values of parameters for computing openings and closures on the image.
+    :roi:
+        Boolean. If True, the QR code is first searched for only in corners of the image,
+        where make_exams places QR codes (see qr_regions). The whole image is searched only
+        if no QR code is found in any of the corners.
+    :time_budget:
+        The maximal time in seconds spent on decoding the image. If None, there is no limit.
 
     Returns:
         A list of pyzbar objects with decoded QR codes. The list is empty if no codes
-        were found.
+        were found. Locations of QR codes are given in coordinates of the whole image.
     '''
 
-    # read a QR code
-    qr = pyz.decode(img, symbols=[pyz.ZBarSymbol.QRCODE]) # look for QR codes only
+    return get_qr_decoder(xmax, ymax, roi).decode(img, time_budget = time_budget)
 
-    # if QR code is not found, modify the image and try again
-    if len(qr) == 0:
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        thresh = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)[1]
-        for i, j in [(i, j) for i in range(1, xmax+1) for j in range(1, ymax+1)]:
-            opened = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, np.ones((i, j)))
-            opened = cv2.bitwise_not(opened)
-            qr = pyz.decode(opened, symbols=[pyz.ZBarSymbol.QRCODE]) # look for QR codes only
-            if len(qr) != 0:
-                break
-            closed = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, np.ones((i, j)))
-            closed = cv2.bitwise_not(closed)
-            qr = pyz.decode(closed, symbols=[pyz.ZBarSymbol.QRCODE]) # look for QR codes only
-            if len(qr) != 0:
-                break
-    return qr
+
+def qr_rotation(qr, shape):
+    """
+    Get the angle of rotation of an exam page from the location of
+    its QR code. The function assumes that the QR code on a unrotated 
+    page is placed in the upper right corner. If the location of the 
+    QR code is inconclusive, the orientation of the QR code symbol 
+    reported by zbar is used instead. 
+
+    :qr:
+        A pyzbar object with the QR code decoded from the page. 
+    :shape:
+        The shape of the numpy array with the image of the page. 
+
+    Returns:
+        The angle of rotation (counterclockwise) or None if it can't 
+        be determined. 
+    """
+
+    h, w, *_ = shape
+    left = qr.rect.left
+    top =  qr.rect.top
+    vert = top/h
+    horiz = left/w
+    if vert < 0.5 and horiz > 0.5:
+        return 0
+    if vert < 0.5 and horiz < 0.5:
+        return 90
+    if vert > 0.5 and horiz < 0.5:
+        return 180
+    if vert > 0.5 and horiz > 0.5:
+        return 270
+    # zbar orientation of the symbol: UP is upright, LEFT is read bottom to top,
+    # DOWN is upside down, RIGHT is read top to bottom
+    orientations = {"UP": 0, "LEFT": 90, "DOWN": 180, "RIGHT": 270}
+    return orientations.get(getattr(qr, "orientation", None))
 
 
 def get_rotation(img):
@@ -179,23 +1196,54 @@ def get_rotation(img):
         found on the page. 
     """
 
-    h, w, *_ = img.shape
     qr = enhanced_qr_decode(img)
     if not qr:
         return None
-    left = qr[0].rect.left
-    top =  qr[0].rect.top
-    vert = top/h
-    horiz = left/w
-    if vert < 0.5 and horiz > 0.5:
-        return 0
-    if vert < 0.5 and horiz < 0.5:
-        return 90
-    if vert > 0.5 and horiz < 0.5:
-        return 180
-    if vert > 0.5 and horiz > 0.5:
-        return 270
-    return None
+    return qr_rotation(qr[0], img.shape)
+
+
+def rotate_img(img, angle):
+    """
+    Rotate an image of a page.
+
+    :img:
+        A numpy array with the image.
+    :angle:
+        Angle of rotation (clockwise). Must be a multiple of 90. 
+
+    Returns:
+        A numpy array with the rotated image. 
+    """
+
+    return np.ascontiguousarray(np.rot90(img, k = -(angle//90)))
+
+
+def fill_rotations(rotations):
+    """
+    Fill in missing angles of rotation of pages of a pdf file. A page on which 
+    the orientation could not be detected (e.g. since its QR code is unreadable)
+    is assigned the angle of rotation of the nearest page with a detected orientation; 
+    if two such pages are equally close, the preceding page is used. 
+
+    :rotations:
+        A list with angles of rotation of consecutive pages, with None for pages 
+        where the orientation is not known. 
+
+    Returns:
+        A list of angles of rotation. If the orientation was not detected on 
+        any page, all angles are 0. 
+    """
+
+    known = [n for n, r in enumerate(rotations) if r is not None]
+    if not known:
+        return [0]*len(rotations)
+
+    filled = []
+    for n, r in enumerate(rotations):
+        if r is None:
+            r = rotations[min(known, key = lambda k: (abs(k - n), k))]
+        filled.append(r)
+    return filled
 
 
 def rotate_pdf(angle, pdfin, pdfout = None):
@@ -203,7 +1251,8 @@ def rotate_pdf(angle, pdfin, pdfout = None):
     Rotate a pdf file
     
     :angle:
-        Angle of rotation (clockwise). Must be a multiple of 90. 
+        Angle of rotation (clockwise). Must be a multiple of 90. It can be also 
+        a list with a separate angle for each page of the file. 
     :pdfin:
         Name of the pdf file to be rotated. 
     :pdfout:
@@ -221,9 +1270,12 @@ def rotate_pdf(angle, pdfin, pdfout = None):
     pdf_reader = pdf.PdfFileReader(pdf_in)
     pdf_writer = pdf.PdfFileWriter()
 
+    angles = angle if isinstance(angle, (list, tuple)) else [angle]*pdf_reader.numPages
+
     for pagenum in range(pdf_reader.numPages):
         page = pdf_reader.getPage(pagenum)
-        page.rotateClockwise(angle)
+        if angles[pagenum]:
+            page.rotateClockwise(angles[pagenum])
         pdf_writer.addPage(page)
         
     temp_pdfout = pdfout if pdfout != pdfin else pdfout + "_temp"
@@ -236,12 +1288,11 @@ def rotate_pdf(angle, pdfin, pdfout = None):
 
 def detect_and_rotate(pdfin, pdfout = None):
     """
-    Detects the orientation of pages of a pdf file and rotates the
-    file accordingly to bring it to the unrotated position. It is 
-    assumed that the orientation of all pages in the file is the same 
-    (so all of pages need to be rotated by the same angle), and that 
-    at least one page has a QR code embedded which after the rotation 
-    should be located in the upper righ corner. 
+    Detects the orientation of pages of a pdf file and rotates each page 
+    to bring it to the unrotated position. It is assumed that pages have
+    QR codes embedded which after the rotation should be located in the 
+    upper righ corner. Pages without a readable QR code are rotated by 
+    the same angle as the nearest page where the orientation was detected. 
 
     :pdfin:
         Name of the pdf file to be rotated. 
@@ -253,21 +1304,10 @@ def detect_and_rotate(pdfin, pdfout = None):
         None. 
     """
 
-    pdf_in = open(pdfin, 'rb')
-    pdf_reader = pdf.PdfFileReader(pdf_in)
-
-    rotation = None
-    for pagenum in range(pdf_reader.numPages):
-        page = pdf_reader.getPage(pagenum)
-        pdf_writer = pdf.PdfFileWriter()
-        pdf_writer.addPage(page)
-        page_img = pdfpage2img(pdf_writer)
-        rotation = get_rotation(page_img)
-        if rotation is not None:
-            break
+    rotations = fill_rotations([get_rotation(page_img) for page_img in pdf2imgs(pdfin)])
 
-    if rotation is None: 
+    if not any(rotations): 
         if (pdfout is not None) and (pdfin != pdfout):
             shutil.copyfile(pdfin, pdfout) 
     else:
-        rotate_pdf(rotation, pdfin, pdfout)
+        rotate_pdf(rotations, pdfin, pdfout)
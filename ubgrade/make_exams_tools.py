@@ -1,6 +1,9 @@
 import os
 import io
+import hashlib
 import PyPDF2 as pdf
+from concurrent.futures import ProcessPoolExecutor
+from ubgrade.helpers import PdfStreamWriter
 
 
 from reportlab.lib.pagesizes import letter
@@ -13,7 +16,219 @@ from reportlab.graphics import renderPDF
 
 
 
-def make_exams(template, N, qr_prefix, output_file=None, output_directory = None, add_backpages = False):
+def render_qr_codes(qr_strings):
+
+    '''
+    Renders QR codes to be added to exam pages. This function can be run in
+    worker processes.
+
+    :qr_strings:
+        A list of strings to be encoded in QR codes.
+
+    Returns:
+        Bytes of a pdf file with one page for each QR code.
+    '''
+
+    pdf_bytes = io.BytesIO()
+    c = canvas.Canvas(pdf_bytes, pagesize=letter)
+    for qr_string in qr_strings:
+        c.setFont('Courier', 11.5)
+        c.setFillColor("black")
+        c.drawRightString(6.6*inch,9.54*inch, qr_string)
+
+        qr_code = qr.QrCodeWidget(qr_string, barLevel = "H")
+        bounds = qr_code.getBounds()
+        width = bounds[2] - bounds[0]
+        height = bounds[3] - bounds[1]
+        d = Drawing(transform=[80./width,0,0,80./height,0,0])
+        d.add(qr_code)
+        renderPDF.draw(d, c, 6.65*inch, 9.4*inch)
+        c.showPage()
+    c.save()
+    return pdf_bytes.getvalue()
+
+
+
+def qr_documents(qr_strings, workers = 1):
+
+    '''
+    Generator rendering QR codes with render_qr_codes. 
+
+    :qr_strings:
+        A list of lists of strings to be encoded in QR codes. 
+    :workers:
+        Integer. The number of processes rendering QR codes. If more than 1,
+        at most 2*workers lists are processed ahead of the one which is yielded, 
+        so that memory use stays bounded.
+
+    Yields:
+        PyPDF2 PdfFileReader objects with QR codes, one for each list of strings. 
+    '''
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = []
+            for strings in qr_strings:
+                futures.append(executor.submit(render_qr_codes, strings))
+                if len(futures) > 2*workers:
+                    yield pdf.PdfFileReader(io.BytesIO(futures.pop(0).result()))
+            for future in futures:
+                yield pdf.PdfFileReader(io.BytesIO(future.result()))
+    else:
+        for strings in qr_strings:
+            yield pdf.PdfFileReader(io.BytesIO(render_qr_codes(strings)))
+
+
+
+class ExamTemplate():
+
+    '''
+    Class used to produce copies of an exam with QR codes. The template file is parsed
+    only once, and each of its pages is converted into a form xobject which is shared 
+    by all copies of the exam. The back page is also rendered only once. 
+    '''
+
+    def __init__(self, template, add_backpages = False):
+
+        '''
+        :template:
+            Name of the pdf file to make copies from.
+        :add_backpages:
+            If True, each page of an exam copy will be followed by a back page
+            with a message that this page will not be graded.
+        '''
+
+        # read the template into memory, so that the file is not kept open
+        with open(template, 'rb') as f:
+            source = pdf.PdfFileReader(io.BytesIO(f.read()))
+
+        # container for form xobjects with template pages
+        self.forms_pdf = pdf.PdfFileWriter()
+        self.forms = []
+        self.page_attrs = []
+        for k in range(source.numPages):
+            page = source.getPage(k)
+            contents = page.getContents()
+            form = pdf.generic.DecodedStreamObject()
+            form.setData(contents.getData() if contents is not None else b"")
+            form = form.flateEncode()
+            form[pdf.generic.NameObject("/Type")] = pdf.generic.NameObject("/XObject")
+            form[pdf.generic.NameObject("/Subtype")] = pdf.generic.NameObject("/Form")
+            form[pdf.generic.NameObject("/BBox")] = page.mediaBox
+            if "/Resources" in page:
+                form[pdf.generic.NameObject("/Resources")] = page.raw_get("/Resources")
+            self.forms.append(self.forms_pdf._addObject(form))
+
+            # page attributes which need to be preserved in exam copies
+            attrs = {"/MediaBox" : page.mediaBox}
+            for key in ["/CropBox", "/Rotate", "/Annots"]:
+                if key in page:
+                    attrs[key] = page.raw_get(key)
+            self.page_attrs.append(attrs)
+
+        self.back_page = self.make_back_page() if add_backpages else None
+
+
+    def num_pages(self):
+        return len(self.forms)
+
+
+    def make_back_page(self):
+
+        '''
+        Returns a PyPDF2 page object with the back page of an exam copy.
+        '''
+
+        back_str1 = "THIS PAGE WILL NOT BE GRADED"
+        back_str2 = "USE IT FOR SCRATCHWORK ONLY"
+        back_bytes = io.BytesIO()
+        back = canvas.Canvas(back_bytes, pagesize=letter)
+        back.setFont('Helvetica', 12)
+        back.setFillColor("black")
+        back.drawCentredString(4.25*inch, 8*inch, back_str1)
+        back.drawCentredString(4.25*inch, 7.8*inch, back_str2)
+        back.save()
+        return pdf.PdfFileReader(back_bytes).getPage(0)
+
+
+    def add_copy(self, writer, qr_pages):
+
+        '''
+        Adds a copy of the exam to a pdf file. 
+
+        :writer:
+            A PdfStreamWriter object with the pdf file. 
+        :qr_pages:
+            A list of PyPDF2 page objects with QR codes, one for each page of the exam.
+            Their content is reused as form xobjects.
+        '''
+
+        for k, qr_page in enumerate(qr_pages):
+
+            # the content of the QR code page becomes a form xobject
+            qr_form = qr_page.getContents()
+            qr_form[pdf.generic.NameObject("/Type")] = pdf.generic.NameObject("/XObject")
+            qr_form[pdf.generic.NameObject("/Subtype")] = pdf.generic.NameObject("/Form")
+            qr_form[pdf.generic.NameObject("/BBox")] = qr_page.mediaBox
+            qr_form[pdf.generic.NameObject("/Resources")] = qr_page.raw_get("/Resources")
+
+            # a new page displaying the template page and the QR code 
+            page = pdf.generic.DictionaryObject()
+            page[pdf.generic.NameObject("/Type")] = pdf.generic.NameObject("/Page")
+            for key, value in self.page_attrs[k].items():
+                page[pdf.generic.NameObject(key)] = value
+            xobjects = pdf.generic.DictionaryObject()
+            xobjects[pdf.generic.NameObject("/Template")] = self.forms[k]
+            xobjects[pdf.generic.NameObject("/QR")] = qr_form
+            resources = pdf.generic.DictionaryObject()
+            resources[pdf.generic.NameObject("/XObject")] = xobjects
+            page[pdf.generic.NameObject("/Resources")] = resources
+            contents = pdf.generic.DecodedStreamObject()
+            contents.setData(b"q /Template Do Q q /QR Do Q")
+            page[pdf.generic.NameObject("/Contents")] = contents
+            writer.add_page(page)
+
+            # add back pages if needed
+            if self.back_page is not None:
+                writer.add_page(self.back_page)
+
+
+
+def exam_hash(template, qr_prefix, add_backpages):
+
+    '''
+    Returns a string with a hash of the template file and of the parameters 
+    of make_exams which affect the content of exam copies.
+    '''
+
+    h = hashlib.sha256()
+    with open(template, 'rb') as f:
+        h.update(f.read())
+    h.update(repr((qr_prefix, add_backpages)).encode())
+    return h.hexdigest()
+
+
+
+def read_exam_hash(fname):
+
+    '''
+    Returns the hash saved by make_exams in metadata of a pdf file with exam copies, 
+    or None if the file does not exist, it can't be read, or it does not contain the hash.
+    '''
+
+    if not os.path.isfile(fname):
+        return None
+    try:
+        with open(fname, 'rb') as f:
+            info = pdf.PdfFileReader(f).getDocumentInfo()
+            return None if info is None else info.get("/ExamHash")
+    except Exception:
+        return None
+
+
+
+def make_exams(template, N, qr_prefix, output_file=None, output_directory = None, add_backpages = False, workers = 1, chunk_size = 10, copies_per_file = 1, first_copy = 1, skip_existing = False):
+
 
     '''
     Produces pdf files with copies of an exam with QR codes identifying each page of each copy added.
@@ -39,6 +254,25 @@ def make_exams(template, N, qr_prefix, output_file=None, output_directory = None
     :add_backpages:
         Adds back pages to the pdf file with a message that these pages will not
         be graded. This is intended for two-sided printing.
+    :workers:
+        Integer. The number of processes rendering QR codes. If 1, all QR codes
+        are rendered in the current process.
+    :chunk_size:
+        Integer. The number of exam copies for which QR codes are rendered in one task.
+    :copies_per_file:
+        Integer. The number of exam copies saved in one pdf file. If it is more than 1,
+        files will be named output_file_m-n.pdf where m and n are the numbers of the first
+        and the last exam copy in the file. If None, all copies will be saved in
+        a single file. Resources of the template (fonts, images etc.) are included
+        in each file only once.
+    :first_copy:
+        Integer. The number of the first exam copy. Copies with numbers 
+        first_copy, ..., first_copy + N - 1 will be produced. This can be used 
+        to produce additional copies of an exam. 
+    :skip_existing:
+        Boolean. If True, output files which already exist and were produced from
+        the same template file, with the same qr_prefix and add_backpages values,
+        will not be produced again. 
 
     Returns:
         None
@@ -58,57 +292,48 @@ def make_exams(template, N, qr_prefix, output_file=None, output_directory = None
     if qr_prefix != "":
         qr_prefix = qr_prefix + "-"
 
-    # produce exam copies
-    for n in range(1, N+1):
+    if copies_per_file is None:
+        copies_per_file = N
 
-        source = pdf.PdfFileReader(open(template, 'rb'))
-        print(f"Processing copy number: {n}\r", end="")
-        writer = pdf.PdfFileWriter()
+    # split exam copies between output files
+    last_copy = first_copy + N - 1
+    files = []
+    for first in range(first_copy, last_copy + 1, copies_per_file):
+        last = min(first + copies_per_file - 1, last_copy)
+        if copies_per_file == 1:
+            destination = os.path.join(output_directory, f"{output_file}_{first:03}.pdf")
+        else:
+            destination = os.path.join(output_directory, f"{output_file}_{first:03}-{last:03}.pdf")
+        files.append((destination, list(range(first, last + 1))))
 
-        # iterate over exam pages
-        for k in range(source.numPages):
+    # the hash is saved in metadata of output files, to check if they can be reused
+    hash_str = exam_hash(template, qr_prefix, add_backpages)
+    if skip_existing:
+        existing = [f for f in files if read_exam_hash(f[0]) == hash_str]
+        files = [f for f in files if f not in existing]
+        if len(existing) > 0:
+            print(f"Skipping {len(existing)} existing files.")
 
-            # create a pdf page with the QR code
-            qr_string = f"{qr_prefix}C{n:03}-P{k:02}"
-            pdf_bytes = io.BytesIO()
-
-            c = canvas.Canvas(pdf_bytes, pagesize=letter)
-            c.setFont('Courier', 11.5)
-            c.setFillColor("black")
-            c.drawRightString(6.6*inch,9.54*inch, qr_string)
-
-            qr_code = qr.QrCodeWidget(qr_string, barLevel = "H")
-            bounds = qr_code.getBounds()
-            width = bounds[2] - bounds[0]
-            height = bounds[3] - bounds[1]
-            d = Drawing(transform=[80./width,0,0,80./height,0,0])
-            d.add(qr_code)
-            renderPDF.draw(d, c, 6.65*inch, 9.4*inch)
-            c.save()
-
-            # merge the QR code page with the exam page
-            qr_pdf = pdf.PdfFileReader(pdf_bytes).getPage(0)
-            page = source.getPage(k)
-            page.mergePage(qr_pdf)
-            writer.addPage(page)
-
-            # create and add back pages if needed
-            if  add_backpages:
-                back_str1 = "THIS PAGE WILL NOT BE GRADED"
-                back_str2 = "USE IT FOR SCRATCHWORK ONLY"
-                back_bytes = io.BytesIO()
-                back = canvas.Canvas(back_bytes, pagesize=letter)
-                back.setFont('Helvetica', 12)
-                back.setFillColor("black")
-                back.drawCentredString(4.25*inch, 8*inch, back_str1)
-                back.drawCentredString(4.25*inch, 7.8*inch, back_str2)
-                back.save()
-                back_pdf = pdf.PdfFileReader(back_bytes).getPage(0)
-                writer.addPage(back_pdf)
-
-        # save an exam copy
-        destination  = os.path.join(output_directory, f"{output_file}_{n:03}.pdf")
-        with open(destination, "wb") as foo:
-            writer.write(foo)
+    # produce exam copies; pages are saved to files as soon as they are ready
+    exam_template = ExamTemplate(template, add_backpages = add_backpages)
+    num_pages = exam_template.num_pages()
+    copy_nums = [n for f in files for n in f[1]]
+    destinations = {f[1][0] : f[0] for f in files}
+    last_copies = set(f[1][-1] for f in files)
+    chunks = [copy_nums[i:i + chunk_size] for i in range(0, len(copy_nums), chunk_size)]
+    qr_strings = [[f"{qr_prefix}C{n:03}-P{k:02}" for n in chunk for k in range(num_pages)] for chunk in chunks]
+
+    writer = None
+    for chunk, qr_pdf in zip(chunks, qr_documents(qr_strings, workers = workers)):
+        for i, n in enumerate(chunk):
+            print(f"Processing copy number: {n}\r", end="")
+            if n in destinations:
+                writer = PdfStreamWriter(destinations[n], info = {"/ExamHash" : hash_str})
+            exam_template.add_copy(writer, [qr_pdf.getPage(i*num_pages + k) for k in range(num_pages)])
+            if n in last_copies:
+                writer.close()
+                writer = None
+        if writer is not None:
+            writer.release(qr_pdf)
 
     print("QR coded files ready." + 40*" ")
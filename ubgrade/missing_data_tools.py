@@ -1,6 +1,7 @@
 from ubgrade.grading_base import GradingBase
 from ubgrade.exam_code import ExamCode
-from ubgrade.helpers import pdfpage2img
+from ubgrade.helpers import pdf2imgs
+from ubgrade.file_lock import atomic_write
 import os
 import io
 import json
@@ -8,8 +9,6 @@ import shutil
 import datetime
 
 import matplotlib.pyplot as plt
-import pandas as pd
-import numpy as np
 import cv2
 import PyPDF2 as pdf
 import pdf2image
@@ -87,7 +86,7 @@ def get_pnum(page):
     return new_pnum
 
 
-def get_missing_data(main_dir = None, gradebook = None):
+def get_missing_data(main_dir = None, gradebook = None, page_store = None):
 
     '''
     Process pdf file with exam pages with missing QR codes or 
@@ -99,13 +98,17 @@ def get_missing_data(main_dir = None, gradebook = None):
     :gradebook:
             A csv file used in grading. Must be locates in the main 
             gragind directory. 
+    :page_store:
+        A PageStore object. If given, pages for which the missing data is 
+        provided will be added to it. Otherwise they are saved as pdf files in 
+        the pages subdirectory of the main grading directory.
 
     Returns:
         An interger indicating the number of remaining pages with data 
         missing after this function is finished. 
     '''
 
-    missing_pages = MissingData(main_dir = None, gradebook = gradebook)
+    missing_pages = MissingData(main_dir = main_dir, gradebook = gradebook, page_store = page_store)
 
     for page in missing_pages:
         if page["missing_data"] == "qr":
@@ -124,10 +127,14 @@ class MissingData(GradingBase):
     Class defining mathods used to process pages with missing data. 
     '''
 
-    def __init__(self, main_dir = None, gradebook = None):
+    def __init__(self, main_dir = None, gradebook = None, page_store = None):
 
         '''
-        Arguments are inherited from the GradingBase constructor.
+        :page_store:
+            A PageStore object. If given, pages for which the missing data is provided 
+            will be added to it. Otherwise they are saved as pdf files in self.pages_dir. 
+
+        Other arguments are inherited from the GradingBase constructor.
         '''
 
         GradingBase.__init__(self, main_dir, gradebook, init_grading_data = False)
@@ -136,22 +143,24 @@ class MissingData(GradingBase):
         if not os.path.isfile(self.missing_data_pages):
             raise Exception("File {self.missing_data_pages} not found.")
         
+        self.page_store = page_store
+
         # create temorary pages directory if needed
-        if not os.path.exists(self.pages_dir):
+        if (self.page_store is None) and (not os.path.exists(self.pages_dir)):
             os.makedirs(self.pages_dir)
 
         # read gradebook, add qr_code column if needed
-        self.gradebook_df = pd.read_csv(self.gradebook, converters={self.pnum_column : str, self.qr_code_column : str})
-        if self.qr_code_column not in self.gradebook_df.columns:
-            self.gradebook_df[self.qr_code_column] = ""
+        self.gradebook_data = self.get_gradebook()
 
 
         # read pdf with missing data
-        self.missing_data_file = open(self.missing_data_pages, 'rb')
-        self.missing_data_pdf = pdf.PdfFileReader(self.missing_data_file)
+        # the file is read into memory, since it is replaced once the processing of pages 
+        # is finished, while its pages can be still used by the page store
+        with open(self.missing_data_pages, 'rb') as f:
+            self.missing_data_pdf = pdf.PdfFileReader(io.BytesIO(f.read()))
 
         # a list with information about pages with missing QR/person number data
-        self.missing_data = self.get_grading_data()["missing_data"]
+        self.missing_data = self.grading_state.get_missing_data()
 
         # writer object for collecting pages with missing data
         self.new_missing_data_writer = pdf.PdfFileWriter()
@@ -165,6 +174,13 @@ class MissingData(GradingBase):
         # number of the page currently being processed
         self.current_page_num = 0
 
+        # images of pages of the pdf file with missing data; pages are rendered
+        # in batches, when they are needed
+        self.page_images = pdf2imgs(self.missing_data_pages, last_page = self.num_pages)
+        # the number of page images obtained so far, and the image of the last of these pages
+        self.num_page_images = 0
+        self.page_image = None
+
         # set additional properties
         self.set_page_data()
 
@@ -181,8 +197,7 @@ class MissingData(GradingBase):
             self.page_data = self.missing_data[self.current_page_num]
             self.qr = self.page_data["qr"]
             self.pnum  = self.page_data["pnum"]
-            self.pdf_page = pdf.PdfFileWriter()
-            self.pdf_page.addPage(self.missing_data_pdf.getPage(self.current_page_num))
+            self.pdf_page = self.missing_data_pdf.getPage(self.current_page_num)
         else:
             self.page_data = None
             self.qr = None
@@ -190,6 +205,19 @@ class MissingData(GradingBase):
             self.pdf_page = None
 
 
+    def get_page_image(self):
+
+        '''
+        Returns a numpy array with the image of the current page.
+        '''
+
+        # skip over images of pages that did not need to be displayed
+        while self.num_page_images <= self.current_page_num:
+            self.page_image = next(self.page_images)
+            self.num_page_images += 1
+        return self.page_image
+
+
     def next_page(self):
 
         '''
@@ -206,7 +234,7 @@ class MissingData(GradingBase):
         Checks if the value of self.pnum corresponds to a person number exists in the gradebook
         '''
 
-        return (self.pnum is not None) and (self.pnum in self.gradebook_df[self.pnum_column].values)
+        return self.gradebook_data.has_pnum(self.pnum)
 
 
     def data_is_complete(self):
@@ -234,15 +262,18 @@ class MissingData(GradingBase):
         '''
 
         if ExamCode(self.qr).is_cover():
-            # find the number of the row in the dataframe with the person number
-            i = np.flatnonzero(self.gradebook_df[self.pnum_column].values == self.pnum)[0]
             # record the QR code of a student exam in the gradebook
-            self.gradebook_df.loc[i, self.qr_code_column] = ExamCode(self.qr).get_exam_code()
+            self.gradebook_data.set_qr(self.pnum, ExamCode(self.qr).get_exam_code())
 
-        # save the page to a pdf file
-        page_file = os.path.join(self.pages_dir, self.qr + ".pdf")
-        with open(page_file , 'wb') as f:
-            self.pdf_page.write(f)
+        # add the page to the page store, or save it to a pdf file
+        if self.page_store is not None:
+            self.page_store.add_page(self.qr + ".pdf", self.pdf_page)
+        else:
+            page = pdf.PdfFileWriter()
+            page.addPage(self.pdf_page)
+            page_file = os.path.join(self.pages_dir, self.qr + ".pdf")
+            with open(page_file , 'wb') as f:
+                page.write(f)
 
 
     def cleanup(self):
@@ -251,26 +282,22 @@ class MissingData(GradingBase):
         Tasks to be performed when processing of  missing data pages is finished. 
         '''
 
+        # the generator of page images keeps the file with missing data open,
+        # it must be closed before the file is replaced or removed
+        self.page_images.close()
+
         # if there are pages with still missing data, save them
         if len(self.new_missing_data) > 0:
-            temp_file = self.missing_data_pages + "_temp"
-            with open(temp_file, 'wb') as f:
+            with atomic_write(self.missing_data_pages, 'wb') as f:
                 self.new_missing_data_writer.write(f)
-
-            self.missing_data_file.close()
-            os.remove(self.missing_data_pages)
-            os.rename(temp_file, self.missing_data_pages)
         else: 
-            self.missing_data_file.close()
             os.remove(self.missing_data_pages)
 
         #save grading data
-        grading_data = self.get_grading_data()
-        grading_data["missing_data"] = self.new_missing_data
-        self.set_grading_data(grading_data)
+        self.grading_state.set_missing_data(self.new_missing_data)
 
         # save the gradebook
-        self.gradebook_df.to_csv(self.gradebook, index=False)
+        self.gradebook_data.save()
 
     
     def append_new_missing_data(self):
@@ -311,13 +338,11 @@ class MissingData(GradingBase):
 
         elif pnum == "add":
             # add a timestamp to the gradebook indicating when the person number was added
-            if self.pnum_time_column not in self.gradebook_df.columns:
-                self.gradebook_df[self.pnum_time_column] = ""
+            if self.pnum_time_column not in self.gradebook_data.df.columns:
+                self.gradebook_data.df[self.pnum_time_column] = ""
             now = datetime.datetime.now()
             dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
-            new_row = {self.pnum_column:[self.pnum], self.pnum_time_column: [dt_string]}
-            new_row_df = pd.DataFrame(new_row)
-            self.gradebook_df = self.gradebook_df.append(new_row_df, sort=False).reset_index().drop(columns = ["index"])
+            self.gradebook_data.add_row({self.pnum_column: self.pnum, self.pnum_time_column: dt_string})
         
         else:
             self.pnum = pnum
@@ -353,7 +378,7 @@ class MissingData(GradingBase):
             return {"missing_data" : "qr", 
                     "page" : self.page_data['page'], 
                     "fname" : self.page_data['fname'],
-                    "image" : pdfpage2img(self.pdf_page)
+                    "image" : self.get_page_image()
                     }
         
         else:
@@ -361,5 +386,5 @@ class MissingData(GradingBase):
                     "pnum" : self.pnum,
                     "page" : self.page_data['page'], 
                     "fname" : self.page_data['fname'],
-                    "image" : pdfpage2img(self.pdf_page)
+                    "image" : self.get_page_image()
                     }
\ No newline at end of file
@@ -0,0 +1,136 @@
+import os
+import io
+import PyPDF2 as pdf
+
+
+
+class PageStore():
+
+    '''
+    Class used to pass individual exam pages between stages of the preparation
+    of grading files. Pages are stored in memory as PyPDF2 page objects, labeled
+    by names of the form used for files of exam pages (e.g. "MTH309-C002-P03.pdf"
+    or "t_MTH309-C002-P03.pdf"). Pdf files the pages come from are kept open until
+    the close method is called.
+    '''
+
+    def __init__(self, debug_dir = None):
+
+        '''
+        :debug_dir:
+            If not None, each page added to the store will be also saved as a pdf
+            file in this directory, with the name of the page as the file name.
+            This can be useful for troubleshooting.
+        '''
+
+        self.pages = {}
+        self.files = []
+        self.debug_dir = debug_dir
+
+        if (self.debug_dir is not None) and (not os.path.exists(self.debug_dir)):
+            os.makedirs(self.debug_dir)
+
+
+    def open_pdf(self, fname, in_memory = False):
+
+        '''
+        Opens a pdf file with pages which will be added to the store.
+
+        :fname:
+            The name of the pdf file.
+        :in_memory:
+            Boolean. If True, the content of the file will be read into memory,
+            so that the file can be modified or deleted while its pages are in the
+            store. Otherwise the file remains open until the store is closed.
+
+        Returns:
+            A PyPDF2 PdfFileReader object.
+        '''
+
+        if in_memory:
+            with open(fname, 'rb') as f:
+                return pdf.PdfFileReader(io.BytesIO(f.read()))
+        f = open(fname, 'rb')
+        self.files.append(f)
+        return pdf.PdfFileReader(f)
+
+
+    def add_page(self, name, page):
+
+        '''
+        Adds a page to the store. If the store already contains a page with the
+        same name, it is replaced.
+
+        :name:
+            The name of the page.
+        :page:
+            A PyPDF2 PageObject.
+        '''
+
+        self.pages[name] = page
+
+        if self.debug_dir is not None:
+            self.write_pdf([name], os.path.join(self.debug_dir, name))
+
+
+    def add_pages(self, fname, names):
+
+        '''
+        Adds all pages of a pdf file to the store.
+
+        :fname:
+            The name of the pdf file.
+        :names:
+            A list with names of consecutive pages of the file.
+        '''
+
+        reader = self.open_pdf(fname, in_memory = True)
+        for n, name in enumerate(names):
+            self.add_page(name, reader.getPage(n))
+
+
+    def get_page(self, name):
+        return self.pages[name]
+
+
+    def names(self):
+
+        '''
+        Returns a sorted list of names of pages in the store.
+        '''
+
+        return sorted(self.pages)
+
+
+    def __contains__(self, name):
+        return name in self.pages
+
+
+    def write_pdf(self, names, output_fname):
+
+        '''
+        Saves pages from the store to a pdf file.
+
+        :names:
+            A list of names of pages to be saved.
+        :output_fname:
+            The name of the pdf file.
+        '''
+
+        writer = pdf.PdfFileWriter()
+        for name in names:
+            writer.addPage(self.pages[name])
+        with open(output_fname, 'wb') as f:
+            writer.write(f)
+
+
+    def close(self):
+
+        '''
+        Removes all pages from the store and closes pdf files they come from.
+        '''
+
+        self.pages = {}
+        for f in self.files:
+            f.close()
+        self.files = []
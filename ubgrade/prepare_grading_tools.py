@@ -1,17 +1,20 @@
 from ubgrade.grading_base import GradingBase
 from ubgrade.exam_code import ExamCode
-from ubgrade.helpers import pdfpage2img, enhanced_qr_decode, merge_pdfs, rotate_pdf, detect_and_rotate
+from ubgrade.helpers import pdf2imgs, get_qr_decoder, qr_rotation, rotate_img, fill_rotations, insert_pages
 from ubgrade.missing_data_tools import get_missing_data
+from ubgrade.page_store import PageStore
+from ubgrade.file_lock import atomic_write
 
 import os
 import glob
 import io
+import copy
+import bisect
 import json
-import shutil
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
-import pandas as pd
 import numpy as np
 import pyzbar.pyzbar as pyz
 import cv2
@@ -36,7 +39,7 @@ class PrepareGrading(GradingBase):
     Class defining mathods used to prepare exams for grading.
     '''
 
-    def __init__(self, maxpoints, main_dir = None, gradebook = None, init_grading_data=False, show_pnums = False):
+    def __init__(self, maxpoints, main_dir = None, gradebook = None, init_grading_data=False, show_pnums = False, qr_time_budget = None):
 
         '''
         :maxpoints:
@@ -47,6 +50,9 @@ class PrepareGrading(GradingBase):
         :show_pnums:
             Boolean. If True, then when person numbers are read from  exam cover pages, images showing the reading process
             will be displayes.
+        :qr_time_budget:
+            The maximal time in seconds spent on decoding the QR code of a single page. 
+            If None, there is no time limit.
 
         The remaining arguments are inherited from the GradingBase constructor.
         '''
@@ -57,29 +63,100 @@ class PrepareGrading(GradingBase):
             maxpoints = [maxpoints]
         self.maxpoints = maxpoints
         self.show_pnums = show_pnums
+        self.qr_time_budget = qr_time_budget
 
+        # statistics of decoding QR codes of scanned pages: the number of pages 
+        # decoded using each image transformation (see helpers.QRDecoder); the key
+        # None counts pages where QR codes were not found
+        self.qr_stats = {}
+
+        # the minimal confidence margin of each digit of a person number read from the bubble 
+        # form (see read_bubbles); person numbers with smaller margins are treated as ambiguous
+        self.min_pnum_margin = 0.05
+        # digits of a person number with confidence margins below this value are treated
+        # as uncertain when person numbers are matched with the gradebook (see match_pnum)
+        self.fuzzy_pnum_margin = 0.1
+
+        # score tables used on exam pages are rendered only once; this dictionary stores 
+        # references to form xobjects with score tables, keys are maximal scores of tables
+        self.score_tables = {}
+        # a container for objects with score tables; references to these objects are 
+        # resolved when pages are written to pdf files
+        self.score_tables_pdf = pdf.PdfFileWriter()
 
 
-    def draw_score_table(self, fname, output_file=None, points=20):
+
+    def score_table_form(self, points=20):
 
         '''
-        Adds score tables to pdf files.
+        Returns a form xobject with a score table. Score tables are rendered 
+        only once for each maximal score, and the same xobject is reused 
+        on all exam pages with the same maximal score. 
 
-        :fname:
-            Name of the source pdf file. The score table will be added to each page of this file.
-        :output_file:
-            Name of the file to be produced. If None, the output file will be saved as t_fname.
         :points:
             Integer. The maximal score in the score table. Should be not more than 25 to fit all score boxes.
 
         Returns:
-            None
+            A PyPDF2 IndirectObject referring to the xobject. 
         '''
 
-        # if no name of the output file given, use the source file name
-        if output_file == None:
-            head, tail = os.path.split(fname)
-            output_file = os.path.join(head, "t_" + tail)
+        if points in self.score_tables:
+            return self.score_tables[points]
+
+        # make pdf with the score table
+        pdf_bytes = io.BytesIO()
+        c = canvas.Canvas(pdf_bytes, pagesize=letter)
+
+        # draw background of the score table
+        c.setLineWidth(.5)
+        c.setStrokeColor("red")
+        c.setFillColorRGB(1, 0.85, 0.85)
+        g = self.table_geometry
+        c.rect(g.table_margin, g.table_margin, g.table_w, g.table_h, stroke=1, fill=1)
+
+        #draw score boxes
+        c.setFont('Helvetica', 10)
+        c.setStrokeColor("black")
+        for i in range(points+1):
+            c.setFillColor("white")
+            c.rect(g.box_left(i),
+                   g.box_bottom,
+                   g.box_size,
+                   g.box_size,
+                   stroke=1, fill=1)
+            c.setFillColor("black")
+            c.drawCentredString(g.box_left(i) + 0.5*g.box_size,
+                                g.text_label_bottom,
+                                str(i))
+        c.save()
+        score_pdf = pdf.PdfFileReader(pdf_bytes).getPage(0)
+
+        # convert the page with the score table into a form xobject
+        form = pdf.generic.DecodedStreamObject()
+        form.setData(score_pdf.getContents().getData())
+        form = form.flateEncode()
+        form[pdf.generic.NameObject("/Type")] = pdf.generic.NameObject("/XObject")
+        form[pdf.generic.NameObject("/Subtype")] = pdf.generic.NameObject("/Form")
+        form[pdf.generic.NameObject("/BBox")] = score_pdf.mediaBox
+        form[pdf.generic.NameObject("/Resources")] = score_pdf["/Resources"]
+
+        self.score_tables[points] = self.score_tables_pdf._addObject(form)
+        return self.score_tables[points]
+
+
+    def score_table_page(self, source, points=20):
+
+        '''
+        Adds a score table to a pdf page.
+
+        :source:
+            A PyPDF2 PageObject with the page.
+        :points:
+            Integer. The maximal score in the score table. Should be not more than 25 to fit all score boxes.
+
+        Returns:
+            A PyPDF2 PageObject with the page with the score table added.
+        '''
 
         # if source pdf is rotated we need to adjust parameters for merging it with
         # the score table; rotations dictionary stores these parameters for all possible
@@ -94,72 +171,91 @@ class PrepareGrading(GradingBase):
         # dictionary may need to be adjusted as well
         scale = 0.95
 
-        source_file = pdf.PdfFileReader(open(fname, 'rb'))
-        writer = pdf.PdfFileWriter()
-
-        # iterate over source pages
-        for k in range(source_file.numPages):
-
-            source = source_file.getPage(k)
-
-            # make pdf with the score table
-            pdf_bytes = io.BytesIO()
-            c = canvas.Canvas(pdf_bytes, pagesize=letter)
-
-            # draw background of the score table
-            c.setLineWidth(.5)
-            c.setStrokeColor("red")
-            c.setFillColorRGB(1, 0.85, 0.85)
-            c.rect(self.table_margin, self.table_margin, self.table_w, self.table_h, stroke=1, fill=1)
-
-            #draw score boxes
-            c.setFont('Helvetica', 10)
-            c.setStrokeColor("black")
-            for i in range(points+1):
-                c.setFillColor("white")
-                c.rect(self.table_margin + self.box_left_pad +i*(self.box_size + self.box_spacing),
-                       self.box_bottom,
-                       self.box_size,
-                       self.box_size,
-                       stroke=1, fill=1)
-                c.setFillColor("black")
-                c.drawCentredString(self.table_margin + self.box_left_pad +i*(self.box_size + self.box_spacing) + 0.5*self.box_size,
-                                    self.text_label_bottom,
-                                    str(i))
-            c.save()
-            score_pdf = pdf.PdfFileReader(pdf_bytes).getPage(0)
-
-            # get rotation angle of the source pdf
-            try:
-                rot = int(source.get('/Rotate'))%360
-            except:
-                rot = 0
+        # a letter size page displaying the score table
+        score_pdf = pdf.pdf.PageObject.createBlankPage(width = letter[0], height = letter[1])
+        table = pdf.generic.DecodedStreamObject()
+        table.setData(b"q /ScoreTable Do Q")
+        score_pdf[pdf.generic.NameObject("/Contents")] = table
+        score_pdf[pdf.generic.NameObject("/Resources")] = pdf.generic.DictionaryObject({
+            pdf.generic.NameObject("/XObject"): pdf.generic.DictionaryObject({
+                pdf.generic.NameObject("/ScoreTable"): self.score_table_form(points)
+            })
+        })
+
+        # get rotation angle of the source pdf
+        try:
+            rot = int(source.get('/Rotate'))%360
+        except:
+            rot = 0
+
+        # merge the score table with the source pdf
+        score_pdf.mergeRotatedScaledTranslatedPage(source, scale = scale, **rotations[rot], expand=False)
+        return score_pdf
+
+
+    def draw_score_table(self, fname, output_file=None, points=20):
+
+        '''
+        Adds score tables to pdf files.
+
+        :fname:
+            Name of the source pdf file. The score table will be added to each page of this file.
+        :output_file:
+            Name of the file to be produced. If None, the output file will be saved as t_fname.
+        :points:
+            Integer. The maximal score in the score table. Should be not more than 25 to fit all score boxes.
+
+        Returns:
+            None
+        '''
+
+        # if no name of the output file given, use the source file name
+        if output_file == None:
+            head, tail = os.path.split(fname)
+            output_file = os.path.join(head, "t_" + tail)
+
+        with open(fname, 'rb') as f:
+            source_file = pdf.PdfFileReader(f)
+            writer = pdf.PdfFileWriter()
+
+            # iterate over source pages
+            for k in range(source_file.numPages):
+                writer.addPage(self.score_table_page(source_file.getPage(k), points = points))
+
+            # save the output file
+            with open(output_file, "wb") as foo:
+                    writer.write(foo)
+
+
+    def page_max_score(self, page_num):
+
+        '''
+        Returns the maximal score of an exam page.
 
-            # merge the score table with the source pdf and save it
-            score_pdf.mergeRotatedScaledTranslatedPage(source, scale = scale, **rotations[rot], expand=False)
-            writer.addPage(score_pdf)
+        :page_num:
+            The number of the page (the cover page is page 0).
+        '''
 
-        # save the output file
-        with open(output_file, "wb") as foo:
-                writer.write(foo)
+        return self.maxpoints[min(page_num-1, len(self.maxpoints)-1)]
 
 
-    def add_score_tables(self):
+    def add_score_tables(self, page_store):
 
         '''
-        Adds score tables to pdf files with exam pages. The resulting files
-        are saved in the self.pages_dir with names prefixed by 't_'.
+        Adds score tables to exam pages. The resulting pages are added to 
+        the page store with names prefixed by 't_'.
         I also writes the information what is the maximal score for each exam
         problem into the json file with grading data.
+
+        :page_store:
+            A PageStore object with exam pages.
         '''
 
-        # select pdf files with exam pages which do not have a score table
-        files = glob.glob(os.path.join(self.pages_dir, "*.pdf"))
-        files = [f for f in files if not ExamCode(f).has_table()]
-        files.sort()
+        # select exam pages which do not have a score table
+        files = [f for f in page_store.names() if not ExamCode(f).has_table()]
 
-        grading_data = self.get_grading_data()
-        max_score_dict = grading_data["maxpoints"]
+        # maximal scores of exam pages
+        max_score_dict = {}
 
         # iterate over pdf file with exam pages
         for f in files:
@@ -169,52 +265,56 @@ class PrepareGrading(GradingBase):
 
             # if cover page, just copy it
             if fcode.is_cover():
-                shutil.copy(f, output_file)
+                page_store.add_page(output_file, page_store.get_page(f))
                 continue
 
             # get the maximum score for an exam page
             page_num = fcode.get_page_num()
-            max_score = self.maxpoints[min(page_num-1, len(self.maxpoints)-1)]
-            max_score_dict[page_num] = max_score
+            max_score = self.page_max_score(page_num)
+            max_score_dict[str(page_num)] = max_score
 
             # pages worth 0 points do not get score tables added
             if max_score == 0:
-                shutil.copy(f, output_file)
+                page_store.add_page(output_file, page_store.get_page(f))
                 continue
 
-            # add the score table
-            self.draw_score_table(fname = f, output_file = output_file, points=max_score)
+            # add the score table; all pages share the same form xobject with the 
+            # score table, so this is fast and it is done in the current process
+            page_store.add_page(output_file, self.score_table_page(page_store.get_page(f), points=max_score))
             print(f"{fcode.base} -> Done\r", end="")
 
-        # save the dictionary with maximal possible scores to grading data
-        grading_data = self.get_grading_data()
-        grading_data["maxpoints"] = max_score_dict
-        self.set_grading_data(grading_data)
+        # save maximal possible scores to grading data
+        self.grading_state.update_maxpoints(max_score_dict)
 
         print("Score tables added")
 
 
-    def read_bubbles(self, img, dilx=(4,10), dily=(10, 4)):
+    def read_bubbles(self, img, dilx=(4,10), dily=(10, 4), form_region=((0.3, 0.85), (0.05, 0.65))):
 
         '''
         Reads person number from the bubble form on the exam cover page. In order
         for this function to work properly the rectangle with the bubble form must be
-        detected as the countour with the largest area on the page. Preprocessing will
-        remove light colors, so a light background etc. will not interfere with this.
+        detected as the countour with the largest area within the region of the page
+        where the form is expected. Preprocessing will remove light colors, so a light 
+        background etc. will not interfere with this.
 
         :img:
             A numpy array encoding an image of the cover page
-        :show_plot:
-            If True displays plots illustating the image analysis.
-            Useful for troubleshooting.
         :dilx:
         :dily:
             Tuples of two integers. They are used to dilate the image, making edges thicker which
             can help to find the contour of the bubble form. Dilations specified by dilx and dily
             are applied to the image consecutively (x direction first, then y).
+        :form_region:
+            A tuple ((top, bottom), (left, right)) giving the part of the page, as fractions of its 
+            height and width, where the bubble form is searched for. If the form is not found there,
+            the whole page is searched. 
 
         Returns:
-            An integer with the person number.
+            A tuple consisting of a string with the person number and a list of confidence
+            margins, one for each digit. The margin of a digit is the difference between the 
+            average brightness (on the 0-1 scale) of the second darkest and the darkest bubble 
+            in the column of the bubble form. Small margins indicate ambiguous reads. 
         '''
 
 
@@ -237,30 +337,51 @@ class PrepareGrading(GradingBase):
             return a[ordering]
 
 
+        def find_form(img):
+
+            '''
+            Finds the contour with the largest area in an image. Returns the 
+            image with detected edges and an array with vertices of the polygon
+            approximating the contour.
+            '''
+
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)  # make grayscale
+            gray= cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY)[1]  #convert to binary
+            gray = cv2.medianBlur(gray,5)  # blur to remove noise
+            gray = cv2.Canny(gray, 75, 150) # find edges
+
+            # thicken edges
+            gray = cv2.dilate(gray, np.ones(dilx))
+            gray = cv2.dilate(gray, np.ones(dily))
+            gray = cv2.morphologyEx(gray, cv2.MORPH_OPEN, np.ones((5, 5)))
+
+            # find the contour with the largest area
+            cnts = cv2.findContours(gray, cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)[0]
+            if len(cnts) == 0:
+                return gray, np.zeros((0, 1, 2), dtype = "int32")
+            frame = max(cnts, key=cv2.contourArea)[:, 0, :]
+            peri = cv2.arcLength(frame, True)
+            approx = cv2.approxPolyDP(frame, 0.02 * peri, True)
+            return gray, approx
+
+
         if img.shape[2] > 3:
             img = img[:, :, :-1]
         if np.max(img) < 1.5:
             img = img*255
         img = img.astype("uint8")
 
-
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)  # make grayscale
-        gray= cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY)[1]  #convert to binary
-        gray = cv2.medianBlur(gray,5)  # blur to remove noise
-        gray = cv2.Canny(gray, 75, 150) # find edges
-
-        # thicken edges
-        gray = cv2.dilate(gray, np.ones(dilx))
-        gray = cv2.dilate(gray, np.ones(dily))
-        gray = cv2.morphologyEx(gray, cv2.MORPH_OPEN, np.ones((5, 5)))
-
-
-        # find the contour with the largest area
-        cnts = cv2.findContours(gray.copy(), cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)[0]
-        cnts = sorted(cnts, key=cv2.contourArea, reverse=True)
-        frame = cnts[0][:, 0, :]
-        peri = cv2.arcLength(frame, True)
-        approx = cv2.approxPolyDP(frame, 0.02 * peri, True)
+        # look for the bubble form in the part of the page where it is expected first;
+        # this is much faster than edge detection on the whole page
+        (top, bottom), (left, right) = form_region
+        h, w = img.shape[:2]
+        top, bottom, left, right = int(top*h), int(bottom*h), int(left*w), int(right*w)
+        gray, outline = find_form(img[top:bottom, left:right])
+        if len(outline) == 4:
+            approx = outline + np.array([left, top])
+        else:
+            gray, outline = find_form(img)
+            approx = outline
 
         # apply perspective transformation to rectify the image within the countour
         pts1 = sort_corners(np.array(approx[:, 0, :], dtype = "float32"))
@@ -277,11 +398,17 @@ class PrepareGrading(GradingBase):
         x = np.linspace(18, 780, 9).astype(int)
         y = np.linspace(165, 860, 11).astype(int)
 
+        # sums of pixel values over rows and columns of the grid give
+        # average pixel values of all cells at once
+        grid = dst[y[0]:y[-1], x[0]:x[-1]].astype(np.int64)
+        sums = np.add.reduceat(np.add.reduceat(grid, y[:-1] - y[0], axis=0), x[:-1] - x[0], axis=1)
+        means = sums/np.outer(np.diff(y), np.diff(x))/255
+
         # for each column find the row number with the lowest average pixel value
-        selected = []
-        for i in range(len(x) - 1):
-            g = [int(np.mean(dst[y[j]:y[j+1], x[i]:x[i+1]]))  for j in range(len(y)-1)]
-            selected.append(g.index(min(g)))
+        # and the margin separating it from the next darkest row
+        selected = np.argmin(means, axis=0)
+        darkest = np.sort(means, axis=0)[:2]
+        margins = (darkest[1] - darkest[0]).round(3).tolist()
 
         # plots, just to check how the image analysis went
         if self.show_pnums:
@@ -291,7 +418,7 @@ class PrepareGrading(GradingBase):
             plt.yticks([])
             im = cv2.bitwise_not(gray)
             plt.imshow(im, cmap="gray")
-            plt.fill(approx[:, 0, 0], approx[:, 0,  1], edgecolor='r', lw=3, fill=False)
+            plt.fill(outline[:, 0, 0], outline[:, 0,  1], edgecolor='r', lw=3, fill=False)
             plt.subplot(132)
             plt.xticks([])
             plt.yticks([])
@@ -306,46 +433,257 @@ class PrepareGrading(GradingBase):
                         [y[j], y[j], y[j+1], y[j+1], y[j]],
                         'r' , alpha = 0.3
                         )
+                plt.text((x[i] + x[i+1])/2, y[0] - 10, f"{margins[i]:.2f}", ha = "center", color = "r")
             plt.show()
 
-        person_number = sum([d*10**i for i, d in enumerate(selected[::-1])])
-        return str(person_number)
+        person_number = sum([int(d)*10**i for i, d in enumerate(selected[::-1])])
+        return str(person_number), margins
 
 
    
-    def read_scans(self, scans, skip_codes = []):
+    def decode_pages(self, scans, first_page=1, last_page=None, skip_codes = [], rotate = None):
+
+        '''
+        Reads QR codes and person numbers from a range of pages of a pdf file
+        with scanned exams. This function does not modify any grading files,
+        so it can be safely run in worker processes.
+
+        :scans:
+            The name of the pdf file to be processed.
+        :first_page:
+        :last_page:
+            Numbers of the first and the last page to be processed (pages are numbered
+            starting with 1). If last_page is None, pages will be processed until the end
+            of the file.
+        :skip_codes:
+            A list of strings. Person numbers are not read from pages with QR codes
+            on this list.
+        :rotate:
+            An integer (a multiple of 90) giving the angle by which all pages should be rotated 
+            clockwise to bring them to the correct orientation. If None, the angle of rotation
+            of each page will be detected from the location of its QR code.
+
+        Returns:
+            A list of dictionaries, one for each page, with keys "page" (the
+            number of the page, counting from 0), "qr" (the content of the QR code
+            found on the page, or None if exactly one QR code was not found),
+            "pnum" (the person number read from the page or None), "pnum_margins" (confidence
+            margins of digits of the person number, see read_bubbles), "qr_method"
+            (the image transformation which decoded the QR code, see helpers.QRDecoder)
+            and "rotation" (the clockwise angle by which the page needs to be rotated,
+            or None if it is not known).
+        '''
+
+        page_data = []
+        for n, page_image in enumerate(pdf2imgs(scans, first_page = first_page, last_page = last_page), start = first_page-1):
+
+            if rotate is not None:
+                page_image = rotate_img(page_image, rotate)
+
+            # get QR code from the page
+            decoder = get_qr_decoder()
+            try:
+                qr_list = decoder.decode(page_image, time_budget = self.qr_time_budget)
+            except:
+                qr_list = []
+            qr = qr_list[0].data.decode('utf8') if len(qr_list) == 1 else None
+
+            # the orientation of the page is given by the location of the QR code
+            if rotate is not None:
+                rotation = rotate
+            elif qr is not None:
+                rotation = qr_rotation(qr_list[0], page_image.shape)
+            else:
+                rotation = None
+
+            # read the person number from cover pages, and from pages where a valid
+            # QR code was not found, so we can process them appropriately later
+            pnum, pnum_margins = None, None
+            if qr not in skip_codes and (qr is None or not ExamCode(qr).valid() or ExamCode(qr).is_cover()):
+                if rotate is None and rotation:
+                    page_image = rotate_img(page_image, rotation)
+                try:
+                    pnum, pnum_margins = self.read_bubbles(page_image)
+                except:
+                    pnum, pnum_margins = None, None
+
+            page_data.append({"page": n, "qr": qr, "pnum": pnum, "pnum_margins": pnum_margins, 
+                              "qr_method": decoder.last_method, "rotation": rotation})
+
+        return page_data
+
+
+    def scan_page_data(self, scans, skip_codes = [], rotate = None, executor = None, chunk_size = 10):
+
+        '''
+        Reads QR codes and person numbers from all pages of a pdf file with
+        scanned exams.
+
+        :scans:
+            The name of the pdf file to be processed.
+        :skip_codes:
+            A list of strings with QR codes of pages that will be skipped.
+        :rotate:
+            The angle by which all pages should be rotated clockwise, or None if the 
+            orientation of pages should be detected automatically.
+        :executor:
+            A concurrent.futures.Executor object. If given, the file will be divided into
+            chunks of pages, and all chunks will be submitted to the executor right away.
+            If None, pages will be processed in the current process, as they are requested.
+        :chunk_size:
+            The number of pages in a chunk.
+
+        Returns:
+            A generator yielding dictionaries with page data returned by the
+            decode_pages method, in the order of pages of the file.
+        '''
+
+        with open(scans, 'rb') as f:
+            num_pages = pdf.PdfFileReader(f).numPages
+        chunks = [(first, min(first + chunk_size - 1, num_pages)) for first in range(1, num_pages + 1, chunk_size)]
+
+        if executor is None:
+            return (d for first, last in chunks for d in self.decode_pages(scans, first, last, skip_codes, rotate))
+
+        worker = self.worker_copy()
+        futures = [executor.submit(worker.decode_pages, scans, first, last, skip_codes, rotate) for first, last in chunks]
+        return (d for future in futures for d in future.result())
+
+
+    def worker_copy(self):
+
+        '''
+        Returns a copy of this object which can be sent to worker processes.
+        '''
+
+        worker = copy.copy(self)
+        # plots of person number reading can't be displayed by worker processes
+        worker.show_pnums = False
+        # score tables are not used by workers, they are not sent to them
+        worker.score_tables = {}
+        worker.score_tables_pdf = pdf.PdfFileWriter()
+        return worker
+
+
+    def read_pnum(self, scans, n, rotation = 0):
+
+        '''
+        Reads the person number from a single page of a pdf file with scanned exams.
+
+        :scans:
+            The name of the pdf file.
+        :n:
+            The number of the page, counting from 0.
+        :rotation:
+            The angle by which the page should be rotated clockwise before reading
+            the person number.
+
+        Returns:
+            A tuple with the person number and confidence margins of its digits, as
+            returned by read_bubbles, or (None, None) if the person number could not be read.
+        '''
+
+        page_image = next(pdf2imgs(scans, first_page = n+1, last_page = n+1))
+        try:
+            return self.read_bubbles(rotate_img(page_image, rotation))
+        except:
+            return None, None
+
+
+    def match_pnum(self, pnum, margins, roster):
+
+        '''
+        Matches a person number read from the bubble form with person numbers 
+        in the gradebook. A person number is matched if it agrees with the number 
+        read on all digits read with confidence, and it differs from it on at most 
+        one digit with a low confidence margin. 
+
+        :pnum:
+            A string with the person number read from the bubble form.
+        :margins:
+            A list with confidence margins of digits of the person number, as 
+            returned by read_bubbles.
+        :roster:
+            A dictionary (or a set) whose keys are person numbers listed in the gradebook.
+
+        Returns:
+            The matching person number from the gradebook, or None if there is no such 
+            person number, or if more than one person number matches. 
+        '''
+
+        # the number read is accepted if it is in the gradebook and all its digits are clear
+        if pnum in roster and min(margins) >= self.min_pnum_margin:
+            return pnum
+
+        # person numbers are compared digit by digit; leading zeros are 
+        # not preserved by read_bubbles
+        k = len(margins)
+        digits = pnum.zfill(k)
+        uncertain = [i for i, m in enumerate(margins) if m < self.fuzzy_pnum_margin]
+
+        # numbers which differ from the number read on at most one uncertain digit 
+        variants = [digits]
+        for i in uncertain:
+            variants += [digits[:i] + d + digits[i+1:] for d in "0123456789" if d != digits[i]]
+
+        candidates = []
+        for v in variants:
+            # the gradebook may list a number with some of its leading zeros omitted
+            zeros = len(v) - len(v.lstrip("0"))
+            for j in range(min(zeros, len(v) - 1) + 1):
+                if v[j:] in roster:
+                    candidates.append(v[j:])
+
+        if len(candidates) == 1:
+            return candidates[0]
+        else:
+            return None
+
+
+    def read_scans(self, scans, page_store, skip_codes = [], page_data = None, rotate = None):
 
         '''
         Given a pdf file with scanned exams:
             - reads the QR code from each page
             - if the page is an exam cover page reads the person number
             - writes the exam code associated to the person number in the gradebook
-            - saves each scanned page as an individual pdf file; the name of this file if the QR code of the page.
+            - adds each scanned page to the page store; the name of the page is the QR code of the page.
             - saves a file with pages where QR code or person number needs to be provided by the user in
               the directory with scnned files.
 
         :scans:
             The name of the pdf file to be processed.
+        :page_store:
+            A PageStore object collecting exam pages.
         :skip_codes:
             A list of of strings. If the content of a QR code detected on an exam page matches one of the 
             strings on this list, the page will be skipped over and will not be processed at all. This can 
             be useful if e.g. scanned exam files include pages with scratchwork which should be ignored.  
+        :page_data:
+            An iterable with QR codes and person numbers read from pages of the file, as returned by
+            the scan_page_data method. If None, pages will be read by this function.
+        :rotate:
+            The angle by which all pages should be rotated clockwise, or None if the 
+            orientation of pages should be detected automatically. Used only if page_data is None.
 
         Returns:
             None
         '''
 
-        # create a temporary directory to store individual exam pages
-        if not os.path.exists(self.pages_dir):
-            os.makedirs(self.pages_dir)
+        if page_data is None:
+            page_data = self.scan_page_data(scans, skip_codes = skip_codes, rotate = rotate)
+        page_data = list(page_data)
+
+        # each page is rotated by the angle detected from its QR code; pages where 
+        # the orientation was not detected are rotated as the nearest page where it was
+        rotations = fill_rotations([d["rotation"] for d in page_data])
+
         # create a directory there files assembled by problem and prepared for grading will be saved
         if not os.path.exists(self.for_grading_dir):
             os.makedirs(self.for_grading_dir)
 
         # read gradebook, add qr_code column if needed
-        gradebook_df = pd.read_csv(self.gradebook, converters={self.pnum_column : str, self.qr_code_column : str})
-        if self.qr_code_column not in gradebook_df.columns:
-            gradebook_df[self.qr_code_column] = ""
+        gradebook = self.get_gradebook()
 
         # writer object for collecting pages with missing data
         missing_data_writer = pdf.PdfFileWriter()
@@ -354,7 +692,12 @@ class PrepareGrading(GradingBase):
         had_missing_file = os.path.isfile(self.missing_data_pages)
 
         # a list with information about pages with missing QR/person number data
-        missing_data = self.get_grading_data()["missing_data"]
+        missing_data = self.grading_state.get_missing_data()
+        # records of pages with missing data found in this file
+        new_missing_data = []
+
+        # a list with information about person numbers matched with the gradebook by match_pnum
+        pnum_corrections = []
 
         # if a file with pages with missing data already exists, copy its
         # content to missing_data_writer; newly discovered pages with missing data
@@ -364,128 +707,145 @@ class PrepareGrading(GradingBase):
             missing_data_pdf = pdf.PdfFileReader(missing_data_file)
             missing_data_writer.appendPagesFromReader(missing_data_pdf)
 
-        # read scans; the file needs to remain open since pdf.PdfFileReader
-        # uses directly this file object - it does not copy it to the memory
-        with open(scans, 'rb') as f:
-            scanned_pdf = pdf.PdfFileReader(f)
-            num_pages = scanned_pdf.numPages
+        # read scans; the file remains open until the page store is closed, since 
+        # pdf.PdfFileReader uses directly this file object - it does not copy it to the memory
+        scanned_pdf = page_store.open_pdf(scans)
 
-            # iterate over pages of the file
-            for n in range(num_pages):
+        # iterate over pages of the file
+        for d, rotation in zip(page_data, rotations):
 
-                # convert the page into a numpy array
-                page = pdf.PdfFileWriter()
-                page.addPage(scanned_pdf.getPage(n))
-                page_image = pdfpage2img(page)
+            n = d["page"]
+            self.qr_stats[d["qr_method"]] = self.qr_stats.get(d["qr_method"], 0) + 1
 
-                # get QR code from the page
-                try:
-                    qr_list = enhanced_qr_decode(page_image)
-                    qr_found = (len(qr_list) == 1)
-                except:
-                    qr_found = False
-                  
-                if qr_found:
-                    qr = qr_list[0].data.decode('utf8')
-                    # skip pages with QR codes listed on the skip_codes list
-                    if qr in skip_codes:
-                        continue
-                    else:
-                        # verify the the QR code is a valid exam code; if not treat the page 
-                        # as a page with a missing QR code 
-                        qr_code = ExamCode(qr)
-                        if not qr_code.valid():
-                            qr_found = False
-                            qr = None
-                else:
-                    qr = None
-
-                # if QR code was found and the page is not a cover page, 
-                # save the  page as a pdf file, the file name is the QR code of the page
-                # then contionue to the next page
-                if qr_found and (not qr_code.is_cover()):
-                    page_file = os.path.join(self.pages_dir, qr + ".pdf")
-                    with open(page_file , 'wb') as f:
-                        page.write(f)
-                    print(qr + 40*" " + "\r", end="")
-                    continue
+            # pages where QR code was not found had person numbers read in their original 
+            # orientation; read them again if the pages need to be rotated
+            if d["rotation"] is None and rotation:
+                d["pnum"], d["pnum_margins"] = self.read_pnum(scans, n, rotation)
+            
+            # the rotation is recorded in the page metadata, the scanned file is not modified
+            if rotation:
+                scanned_pdf.getPage(n).rotateClockwise(rotation)
+
+            qr = d["qr"]
+            qr_found = qr is not None
 
-                # if cover read the person number
-                # also, attempt to read person number on pages where  
-                # QR code was not found, so we can process them appropriately later
+            if qr_found:
+                # skip pages with QR codes listed on the skip_codes list
+                if qr in skip_codes:
+                    continue
                 else:
-                    # read the person number
-                    try:
-                        pnum = self.read_bubbles(page_image)
-                    except:
+                    # verify the the QR code is a valid exam code; if not treat the page 
+                    # as a page with a missing QR code 
+                    qr_code = ExamCode(qr)
+                    if not qr_code.valid():
+                        qr_found = False
+                        qr = None
+            else:
+                qr = None
+
+            # if QR code was found and the page is not a cover page, 
+            # add the page to the page store, the name of the page is the QR code of the page
+            # then contionue to the next page
+            if qr_found and (not qr_code.is_cover()):
+                page_store.add_page(qr + ".pdf", scanned_pdf.getPage(n))
+                print(qr + 40*" " + "\r", end="")
+                continue
+
+            # person number read from cover pages, and from pages where  
+            # QR code was not found, so we can process them appropriately later
+            else:
+                pnum = d["pnum"]
+
+                # match the person number with the gradebook; misread digits with low confidence 
+                # can be corrected here, the remaining person numbers with ambiguous digits are 
+                # discarded, so that they are checked by the user
+                if pnum is not None:
+                    matched = self.match_pnum(pnum, d["pnum_margins"], gradebook.pnum_index)
+                    if matched is not None and (matched != pnum or min(d["pnum_margins"]) < self.min_pnum_margin):
+                        print(f"Person number {pnum} on page {n} of {os.path.basename(scans)} matched with {matched}")
+                        pnum_corrections.append({"fname": os.path.basename(scans),
+                                                 "page": n,
+                                                 "qr": qr if qr_found else None,
+                                                 "read": pnum,
+                                                 "pnum": matched,
+                                                 "margins": d["pnum_margins"]
+                                                 })
+                        pnum = matched
+                    elif matched is None and min(d["pnum_margins"]) < self.min_pnum_margin:
+                        print(f"Ambiguous person number {pnum} on page {n} of {os.path.basename(scans)}")
                         pnum = None
 
-                    # check if the person number read is in the gradebook
-                    pnum_found = (pnum is not None) and (pnum in gradebook_df[self.pnum_column].values)
-
-                    if pnum_found:
-                        print(f"person_number: {pnum}" + 40*" " + "\r", end="")
-                
-                # if we have found all data on a cover page, save the page and record the 
-                # QR code in the gradebook
-                # then contine to the next page
-                if qr_found and qr_code.is_cover() and pnum_found:
-                    # find the number of the row in the dataframe with the person number
-                    i = np.flatnonzero(gradebook_df[self.pnum_column].values == pnum)[0]
-                    # record the QR code of a student exam in the gradebook
-                    gradebook_df.loc[i, self.qr_code_column] = qr_code.get_exam_code()
-                    # save the exam page as a pdf file, the file name is the QR code of the page
-                    page_file = os.path.join(self.pages_dir, qr + ".pdf")
-                    with open(page_file , 'wb') as f:
-                        page.write(f)
-                    print(qr + 40*" " + "\r", end="")
-                    continue
-                
-                # for pages with missing data, record page data 
-                page_missing_data = self.page_missing_data.copy()
-                page_missing_data["fname"] = os.path.basename(scans)
-                page_missing_data["page"] = n
-                page_missing_data["qr"] = qr if qr_found else None
-                page_missing_data["pnum"] = pnum
-
-                if page_missing_data not in missing_data:
-                    missing_data.append(page_missing_data)
-                    missing_data_writer.addPage(scanned_pdf.getPage(n))
+                # check if the person number read is in the gradebook
+                pnum_found = gradebook.has_pnum(pnum)
+
+                if pnum_found:
+                    print(f"person_number: {pnum}" + 40*" " + "\r", end="")
+            
+            # if we have found all data on a cover page, save the page and record the 
+            # QR code in the gradebook
+            # then contine to the next page
+            if qr_found and qr_code.is_cover() and pnum_found:
+                # record the QR code of a student exam in the gradebook
+                gradebook.set_qr(pnum, qr_code.get_exam_code())
+                # add the page to the page store, the name of the page is the QR code of the page
+                page_store.add_page(qr + ".pdf", scanned_pdf.getPage(n))
+                print(qr + 40*" " + "\r", end="")
+                continue
+            
+            # for pages with missing data, record page data 
+            page_missing_data = self.page_missing_data.copy()
+            page_missing_data["fname"] = os.path.basename(scans)
+            page_missing_data["page"] = n
+            page_missing_data["qr"] = qr if qr_found else None
+            page_missing_data["pnum"] = pnum
+
+            if page_missing_data not in missing_data:
+                missing_data.append(page_missing_data)
+                new_missing_data.append(page_missing_data)
+                missing_data_writer.addPage(scanned_pdf.getPage(n))
 
         # if there are pages with missing data, save them
         if len(missing_data) > 0:
-            temp_file = self.missing_data_pages + "_temp"
-            with open(temp_file, 'wb') as f:
+            with atomic_write(self.missing_data_pages, 'wb') as f:
                 missing_data_writer.write(f)
-            if had_missing_file:
-                missing_data_file.close()
-                os.remove(self.missing_data_pages)
-            os.rename(temp_file, self.missing_data_pages)
-            grading_data = self.get_grading_data()
-            grading_data["missing_data"] = missing_data
-            self.set_grading_data(grading_data)
+                # the old file is closed before it is replaced
+                if had_missing_file:
+                    missing_data_file.close()
+            self.grading_state.add_missing_data(new_missing_data)
+
+        # record person numbers matched automatically
+        if len(pnum_corrections) > 0:
+            self.grading_state.add_pnum_corrections(pnum_corrections)
 
         # save the gradebook
-        gradebook_df.to_csv(self.gradebook, index=False)
+        gradebook.save()
 
 
-    def assemble_by_problem(self):
+    def assemble_by_problem(self, page_store, incremental = False):
         
         '''
         Assembles pages of exam copies into files, one file containing
         all copies of a given page. Pages within each file are sorted
         according to their QR codes.
         The information about QR codes of pages in each file is recorded
-        in the grading data json file.
+        in the grading data.
+
+        :page_store:
+            A PageStore object with exam pages.
+        :incremental:
+            Boolean. If True, pages will be inserted into already existing files 
+            at positions given by their QR codes. The existing content of these files, 
+            including annotations added in grading, is not modified. Pages with QR codes 
+            which are already in a file are not inserted. If False, files will be 
+            assembled from pages in the page store only, replacing existing files. 
 
         Returns:
             None.
         '''
 
 
-        files = glob.glob(os.path.join(self.pages_dir, "*.pdf"))
-        # list of pdf file with score tables
-        files = [f for f in files if ExamCode(f).has_table()]
+        # list of pages with score tables
+        files = [f for f in page_store.names() if ExamCode(f).has_table()]
 
         # directory whose keys are file names, and the value is the page number of a file.
         files_dir = {}
@@ -500,40 +860,59 @@ class PrepareGrading(GradingBase):
         # create the set of page (or problem) numbers of the exam
         problems = set(files_dir.values())
 
-        # this dictionary will record which pages are in each assembled pdf file
-        page_lists = {}
+        # lists of pages in already assembled pdf files
+        page_lists = self.grading_state.get_page_lists() if incremental else {}
+        # a file listed in grading data may be missing e.g. if it was moved for grading;
+        # assembling it anew would lose the record of pages it contains
+        missing = [n + ".pdf" for n in sorted(problems) if len(page_lists.get(n + ".pdf", [])) > 0
+                   and not os.path.isfile(os.path.join(self.for_grading_dir, n + ".pdf"))]
+        if len(missing) > 0:
+            raise FileNotFoundError(f"Files {', '.join(missing)} are listed in grading data, but are not in "
+                                    f"the directory {self.for_grading_dir}. Put them back before processing new scans.")
+
         for n in problems:
             # list of pages with the problem n, sorted by QR codes
             f_n = [f for f in files_dir if files_dir[f] == n]
             f_n.sort()
 
-            # save the assembled problem file
             output_fname = os.path.join(self.for_grading_dir, n + ".pdf")
-            merge_pdfs(f_n , output_fname=output_fname)
+            f_list = page_lists.get(os.path.basename(output_fname), [])
 
-            # record the list of pages in the assembled file
-            page_lists[os.path.basename(output_fname)] = [os.path.basename(f) for f in f_n]
+            # insert new pages into the existing problem file
+            if len(f_list) > 0:
+                listed = set(f_list)
+                new_pages = [f for f in f_n if f not in listed]
+                if len(new_pages) == 0:
+                    continue
+                f_list = f_list.copy()
+                for f in new_pages:
+                    bisect.insort(f_list, f)
+                new_set = set(new_pages)
+                positions = [i for i, f in enumerate(f_list) if f in new_set]
+                insert_pages(output_fname, [page_store.get_page(f) for f in new_pages], positions)
+                self.grading_state.set_page_list(os.path.basename(output_fname), f_list)
+                continue
+
+            # save the assembled problem file
+            page_store.write_pdf(f_n , output_fname)
 
-        #save the information about pages of the assembled files in the grading data json file
-        grading_data = self.get_grading_data()
-        grading_data["page_lists"] = page_lists
-        self.set_grading_data(grading_data)
+            # record the list of pages in the assembled file in the grading data
+            self.grading_state.set_page_list(os.path.basename(output_fname), [os.path.basename(f) for f in f_n])
 
 
 
-    def prepare_grading(self, files=None,  rotate=None, skip_codes = [], batch=False):
+    def prepare_grading(self, files=None,  rotate=None, skip_codes = [], batch=False, workers=1, keep_pages=False, incremental=True):
 
         '''
         Prepares exams for grading:
-        - It creates directories "pages", "for_grading", and "graded" in
-            the main grading directory (if they don't exists yet).
+        - It creates the "for_grading" directory in the main grading directory 
+            (if it doesn't exists yet).
         - It reads scanned pdf files in the "scans" directory using the read_scans
-            function.
-        - It adds a score table to each page of the exam directory using the add_score_tables
+            function. Exam pages are collected in a page store kept in memory. 
+        - It adds a score table to each exam page using the add_score_tables
             function.
         - It assembles problem for grading and places them in the "for_grading" directory
             using the assemble_by_problem function.
-        - At the end the "pages" directory is removed, since it is not needed anymore.
 
 
         :files:
@@ -545,10 +924,12 @@ class PrepareGrading(GradingBase):
         :rotate:
             This argument can be an integer (a multiple of 90) giving the angle by which all pages 
             of pdf files should rotated clockwise to bring them to the correct orientation. If None, 
-            the angle of rotation of each file will be automatically detected, using the assumption 
+            the angle of rotation of each page will be automatically detected, using the assumption 
             that on a correctly oriented page the QR code is located in the upper right corner. 
-            The automatic angle detection will check the angle of rotation for each pdf file separately, 
-            but all pages in a given file will be rotated by the same angle.  
+            Pages where the QR code can't be read are rotated by the same angle as the nearest 
+            page of the same file where the orientation was detected. The orientation is detected
+            while QR codes are read, and the rotation is applied only to the extracted exam pages: 
+            scanned files are not modified.  
         :skip_codes:
             A list of of strings. If the content of a QR code detected on an exam page matches one of the 
             strings on this list, the page will be skipped over and will not be processed at all. This can 
@@ -558,86 +939,113 @@ class PrepareGrading(GradingBase):
             saved into a separate file, but there will be no attempt to ask the user to provide 
             the missing data. The missing data can be then added by the user at a later time, 
             by tunning this function again with batch=False. 
+        :workers:
+            The number of worker processes used to read QR codes and person numbers from 
+            scanned pages. If greater than 1, pages of all scanned files are divided into 
+            chunks processed in parallel, while the gradebook and the grading data are updated 
+            by the main process only, in the same order as in a serial run. Workers are used 
+            only to read scans: score tables are added to exam pages in the main process,
+            since all pages share the same form xobjects with score tables. 
+        :keep_pages:
+            Boolean. If True, all individual exam pages will be also saved as pdf files
+            in the "pages" directory, and this directory will not be removed at the end.
+            This can be useful for troubleshooting. 
+        :incremental:
+            Boolean. If True, new exam pages will be inserted into already existing files in 
+            the "for_grading" directory, without modifying pages these files contain. 
+            If False, these files will be reassembled from scratch.  
 
         Returns:
             None
         '''
 
-        # create the pages directory if needed for storing individual exam pages if needed
-        if not os.path.exists(self.pages_dir):
-            os.makedirs(self.pages_dir)
-
-        # get a list of scanned files that have been previously processed
-        processed_scans = self.get_grading_data()["processed_scans"]
-        # if the file with pages with missing data exists we will skip it, to handle it separately
-        processed_scans.append(os.path.basename(self.missing_data_pages))
-        processed_scans_set = set(processed_scans)
-
-        # get the list of files to be processed
-        if files is None:
-            file_list = set([os.path.basename(f) for f in set(glob.glob(os.path.join(self.scans_dir, "*.pdf")))])
-            file_list = list(file_list.difference(processed_scans_set))
-        elif files == "all":
-            file_list = [os.path.basename(f) for f in set(glob.glob(os.path.join(self.scans_dir, "*.pdf")))]
-            if os.path.basename(self.missing_data_pages) in file_list:
-                file_list.remove(os.path.basename(self.missing_data_pages))
-            processed_scans_set = set()
-        elif type(files) == list:
-            file_list = [os.path.basename(f) for f in files]
-
-        file_list.sort()
-
-        print("Reading scanned files...")
-
-        # list collecting names of processed files
-        processed = []
-
-        # iterate over scanned files, getting QR codes and person numbers
-        # files with data missing are collected in the self.missing_data_pages
-        # file, to be processed later
-        for f in file_list:
-            
-            print(f"Reading file:  {f}")
-            fpath = os.path.join(self.scans_dir, f)
-            if not os.path.exists(fpath):
-                print(f"File {f} not found, omitting.")
-                continue
-
-            # rotate pdf pages
-            if rotate is None:
-                detect_and_rotate(pdfin = fpath)
-            else:
-                rotate_pdf(angle = rotate, pdfin = fpath)
-
-            self.read_scans(scans = fpath, skip_codes = skip_codes)
-            processed.append(f)
-
-        # get information about pages with missing QR/person number data
-        if  (not batch) and  os.path.isfile(self.missing_data_pages):
-            print(f"Reading file:  {os.path.basename(self.missing_data_pages)}\n")
-            get_missing_data(gradebook=self.gradebook)
-
-
-        print("Adding score tables..." + 40*" ")
-        self.add_score_tables()
-
-        # We are assuming that we are adding new pages to files with exam problems
-        # that may have been already partially graded. This will reassemble these
-        # problem files so that new pages are added and the already existing
-        # pages are unchanged.
-        self.split_for_grading_files(dest_dir = self.pages_dir)
-        print("Assembling files for grading...")
-        self.assemble_by_problem()
-
-        print("Finishing...")
-        # record information which scanned files has been processed
-        grading_data = self.get_grading_data()
-        num_missing_data_pages = len(grading_data["missing_data"])
-        grading_data["processed_scans"] = list(set(processed_scans_set).union(processed))
-        self.set_grading_data(grading_data)
-
-        # remove the pages directory, it is not needed anymore
-        shutil.rmtree(self.pages_dir)
+        # a store for individual exam pages; with keep_pages they are also saved in the pages directory
+        page_store = PageStore(debug_dir = self.pages_dir if keep_pages else None)
+        # worker processes and pages in the page store are released also if 
+        # an exception is raised or the process is interrupted
+        executor = None
+        try:
+
+            # get a list of scanned files that have been previously processed
+            processed_scans = self.grading_state.get_processed_scans()
+            # if the file with pages with missing data exists we will skip it, to handle it separately
+            processed_scans.append(os.path.basename(self.missing_data_pages))
+            processed_scans_set = set(processed_scans)
+
+            # get the list of files to be processed
+            if files is None:
+                file_list = set([os.path.basename(f) for f in set(glob.glob(os.path.join(self.scans_dir, "*.pdf")))])
+                file_list = list(file_list.difference(processed_scans_set))
+            elif files == "all":
+                file_list = [os.path.basename(f) for f in set(glob.glob(os.path.join(self.scans_dir, "*.pdf")))]
+                if os.path.basename(self.missing_data_pages) in file_list:
+                    file_list.remove(os.path.basename(self.missing_data_pages))
+                processed_scans_set = set()
+            elif type(files) == list:
+                file_list = [os.path.basename(f) for f in files]
+
+            file_list.sort()
+
+            print("Reading scanned files...")
+
+            # list collecting names of processed files
+            processed = []
+
+            for f in file_list:
+                fpath = os.path.join(self.scans_dir, f)
+                if not os.path.exists(fpath):
+                    print(f"File {f} not found, omitting.")
+                    continue
+                processed.append(f)
+
+            # pages of all files are submitted to worker processes at once, 
+            # their results are consumed below in the order of files and pages
+            if workers > 1:
+                executor = ProcessPoolExecutor(max_workers = workers)
+            page_data = {}
+            for f in processed:
+                fpath = os.path.join(self.scans_dir, f)
+                page_data[f] = self.scan_page_data(fpath, skip_codes = skip_codes, rotate = rotate, executor = executor)
+
+            # iterate over scanned files, getting QR codes and person numbers
+            # files with data missing are collected in the self.missing_data_pages
+            # file, to be processed later
+            for f in processed:
+                print(f"Reading file:  {f}")
+                fpath = os.path.join(self.scans_dir, f)
+                self.read_scans(scans = fpath, page_store = page_store, skip_codes = skip_codes, page_data = page_data[f])
+
+            # get information about pages with missing QR/person number data
+            if  (not batch) and  os.path.isfile(self.missing_data_pages):
+                print(f"Reading file:  {os.path.basename(self.missing_data_pages)}\n")
+                get_missing_data(main_dir = self.main_dir, gradebook = self.gradebook, page_store = page_store)
+
+
+            print("Adding score tables..." + 40*" ")
+            self.add_score_tables(page_store)
+
+            if executor is not None:
+                executor.shutdown()
+
+            # We are assuming that we are adding new pages to files with exam problems
+            # that may have been already partially graded. New pages are inserted into 
+            # these problem files, or the files are reassembled with the already existing
+            # pages unchanged.
+            if not incremental:
+                page_lists = self.grading_state.get_page_lists()
+                for f in page_lists:
+                    page_store.add_pages(os.path.join(self.for_grading_dir, f), page_lists[f])
+            print("Assembling files for grading...")
+            self.assemble_by_problem(page_store, incremental = incremental)
+
+            print("Finishing...")
+            # record information which scanned files has been processed
+            num_missing_data_pages = len(self.grading_state.get_missing_data())
+            self.grading_state.add_processed_scans(processed)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            page_store.close()
 
         print("\nGrading files ready.")
         if num_missing_data_pages > 0:
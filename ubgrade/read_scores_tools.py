@@ -1,5 +1,7 @@
-from ubgrade.grading_base import GradingBase
+from ubgrade.grading_base import GradingBase, ScoreTableGeometry
 from ubgrade.exam_code import ExamCode, covers_file
+from ubgrade.gradebook import save_csv
+from ubgrade.helpers import pdf2crops, box_means, otsu_treshold, page_digest
 
 import os
 import glob
@@ -7,9 +9,11 @@ import io
 import json
 import shutil
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import pandas as pd
 import numpy as np
-import pdf2image
+import PyPDF2 as pdf
 
 
 
@@ -20,7 +24,133 @@ class ReadScores(GradingBase):
     '''
 
     @staticmethod
-    def read_problem_scores(fname, maxpoints, treshold = 250):
+    def score_box_means(fname, maxpoints, pages = None, dpi = 72, geometry = None, chunk_size = 50):
+
+        '''
+        Computes mean pixel values of score boxes in score tables embedded in pages of 
+        a pdf file. Each score box is white, so when it is unmarked, the mean of its pixel 
+        values is 255, and it is lower for marked boxes.
+
+        :fname:
+            The name of the pdf file.
+        :maxpoints:
+            The maximum point value of the graded problems.
+        :pages:
+            A list of indices of pages (starting with 0) from which score boxes should be read. 
+            If None, all pages will be read. 
+        :dpi:
+            Resolution at which pages are rendered. Locations of score boxes in page 
+            images are computed from the geometry of score tables, so any resolution 
+            at which a score box is a few pixels wide can be used.
+        :geometry:
+            A ScoreTableGeometry object with dimensions of score tables. If None, 
+            the default dimensions are used.
+        :chunk_size:
+            The number of pages whose images are processed together.
+
+        Returns:
+            A numpy array with one row for each page read and one column for each score box. 
+        '''
+
+        if geometry is None:
+            geometry = ScoreTableGeometry()
+
+        # rotation of pages, which changes the location of score tables in page images
+        with open(fname, 'rb') as f:
+            reader = pdf.PdfFileReader(f)
+            if pages is None:
+                pages = list(range(reader.numPages))
+            rotations = [int(reader.getPage(n).get("/Rotate", 0)) % 360 for n in pages]
+
+        # consecutive pages with the same rotation are rendered together
+        runs = []
+        for n, rotation in zip(pages, rotations):
+            if len(runs) > 0 and runs[-1][1] == n and runs[-1][2] == rotation:
+                runs[-1][1] = n + 1
+            else:
+                runs.append([n + 1, n + 1, rotation])
+
+        means = [np.zeros((0, maxpoints + 1))]
+        for first, last, rotation in runs:
+            boxes = geometry.pixel_boxes(maxpoints, dpi = dpi, rotation = rotation)
+            # only the part of the page with score boxes is rendered
+            left = min(x for x, y, w, h in boxes)
+            top = min(y for x, y, w, h in boxes)
+            width = max(x + w for x, y, w, h in boxes) - left
+            height = max(y + h for x, y, w, h in boxes) - top
+            boxes = [(x - left, y - top, w, h) for x, y, w, h in boxes]
+            # strips of pages are stacked in chunks, and all boxes in a chunk are read at once;
+            # only one chunk of strips is kept in memory
+            strips = []
+            for img in pdf2crops(fname, left, top, width, height, first_page = first, last_page = last, dpi = dpi):
+                strips.append(img)
+                if len(strips) == chunk_size:
+                    means.append(box_means(np.stack(strips), boxes))
+                    strips = []
+            if len(strips) > 0:
+                means.append(box_means(np.stack(strips), boxes))
+        return np.concatenate(means)
+
+
+    @staticmethod
+    def calibrate_treshold(means, default = 250, min_contrast = 30):
+
+        '''
+        Computes a treshold for detecting marked score boxes from mean pixel values
+        of score boxes read from a file, using the Otsu method. This accounts for 
+        files where unmarked score boxes are not white, or marks are light. 
+
+        :means:
+            An array with mean pixel values of score boxes.
+        :default:
+            The treshold used if marked and unmarked boxes can't be separated, e.g. 
+            if no box in the file is marked.
+        :min_contrast:
+            The minimal difference between mean values of the two classes of boxes 
+            found by the Otsu method needed to use the computed treshold.
+
+        Returns:
+            The treshold. 
+        '''
+
+        otsu = otsu_treshold(means)
+        if otsu is None:
+            return default
+        treshold, low_mean, high_mean = otsu
+        if high_mean - low_mean < min_contrast:
+            return default
+        return treshold
+
+
+    @staticmethod
+    def classify_scores(means, treshold = 250):
+
+        '''
+        Converts mean pixel values of score boxes into scores. 
+
+        :means:
+            A numpy array with one row for each page and one column for each score box, 
+            as returned by score_box_means. 
+        :treshold:
+            A score box is counted as marked if its mean pixel value is below the treshold.
+
+        Returns:
+            A list of scores in the format of read_problem_scores.
+        '''
+
+        marked = np.asarray(means) < treshold
+        counts = marked.sum(axis = 1)
+        scores = np.where(counts == 1, marked.argmax(axis = 1), -1).tolist()
+        for n in np.flatnonzero(counts != 1):
+            if counts[n] == 0:
+                scores[n] = "NONE"
+            else:
+                scores[n] = "MULTI: " + str(np.flatnonzero(marked[n]).tolist())
+        return scores
+
+
+    @staticmethod
+    def read_problem_scores(fname, maxpoints, treshold = 250, pages = None, dpi = 72, geometry = None):
 
         '''
         Reads scores from score tables embedded in pages of a pdf file.
@@ -35,51 +165,174 @@ class ReadScores(GradingBase):
             Integer value for detecting if a box of the score table is checked
             or not. Each score box is white, so when it is unmarked, the mean of its
             pixel values is 255. If the mean read from the pdf is below the treshhold
-            we count the score box as marked
+            we count the score box as marked. If None, the treshold will be computed 
+            from the mean values of score boxes read from the file. 
+        :pages:
+            A list of indices of pages (starting with 0) from which scores should be read. 
+            If None, scores will be read from all pages. 
+        :dpi:
+            Resolution at which pages are rendered.
+        :geometry:
+            A ScoreTableGeometry object with dimensions of score tables. If None, 
+            the default dimensions are used.
 
         Returns:
-            A list of scores, one for each pdf page. If no marked score boxes are detected
+            A list of scores, one for each page read. If no marked score boxes are detected
             on a page, the entry the list for the page will be "NONE". If multiple marked
             boxes are detected, the value of the list for the page will be "MULTI" followed by
             the list of detected scores.
         '''
 
-        pages = pdf2image.convert_from_path(fname)
-        # row and column offset of the first score box in the score table
-        row_offset = 2110
-        col_offset = 44
+        means = ReadScores.score_box_means(fname, maxpoints, pages = pages, dpi = dpi, geometry = geometry)
+        if treshold is None:
+            treshold = ReadScores.calibrate_treshold(means)
+        return ReadScores.classify_scores(means, treshold)
+
+
+    def score_boxes(self, maxpoints):
+
+        '''
+        Returns a list of rectangles (x0, y0, x1, y1) of score boxes of a score table,
+        in pdf units relative to the lower left corner of the page. Rectangles are enlarged
+        by half of the spacing between score boxes, so that marks slightly outside a box 
+        are assigned to this box. 
+
+        :maxpoints:
+            The maximum point value of the score table.
+        '''
+
+        g = self.table_geometry
+        return [g.box_rect(i, pad = 0.5*g.box_spacing) for i in range(maxpoints+1)]
+
+
+    def read_annotation_scores(self, fname, maxpoints, pages = None):
+
+        '''
+        Reads scores marked in score tables with pdf annotations (ink, shapes, stamps, 
+        text etc.). A score box is counted as marked if the center of the rectangle
+        of an annotation is inside the box. This does not require rendering pdf pages, 
+        but it does not detect marks which are a part of the page content (e.g. after
+        the pdf file has been flattened). 
+
+        :fname:
+            The name of the pdf file.
+        :maxpoints:
+            The maximum point value of the graded problems.
+        :pages:
+            A list of indices of pages (starting with 0) from which scores should be read. 
+            If None, scores will be read from all pages. 
 
-        # shift from the left edge of one score box to the next one
-        box_shift = 60
-        # width and height of a score box
-        box_size = 30
+        Returns:
+            A list with one entry for each page read, with the format of entries as 
+            in read_problem_scores. If no score box on a page is marked with 
+            annotations, the entry for this page is None. 
+        '''
 
-        #list of scores
+        boxes = self.score_boxes(maxpoints)
         scores = []
-        for page in pages:
-            img = np.array(page)
-            score_table = []
-            # iterate over score boxes in the score table
-            for i in range(maxpoints+1):
-                x = col_offset + i*box_shift
-                box = img[row_offset : row_offset + box_size, x : x + box_size, :]
-                if box.mean() < treshold:
-                    score_table.append(i)
-
-            if len(score_table) == 1:
-                scores.append(score_table[0])
-            elif len(score_table) == 0:
-                scores.append("NONE")
-            else:
-                scores.append("MULTI: " + str(score_table))
+        with open(fname, 'rb') as f:
+            reader = pdf.PdfFileReader(f)
+            if pages is None:
+                pages = range(reader.numPages)
+            for n in pages:
+                page = reader.getPage(n)
+                x_min, y_min = [float(t) for t in page.mediaBox.lowerLeft]
+                score_table = set()
+                for annot in page.get("/Annots", []):
+                    annot = annot.getObject()
+                    # skip annotations which do not mark the page and hidden annotations
+                    if annot.get("/Subtype") in ["/Link", "/Popup", "/Widget"] or int(annot.get("/F", 0)) & 2:
+                        continue
+                    if "/Rect" not in annot:
+                        continue
+                    x0, y0, x1, y1 = [float(t) for t in annot["/Rect"]]
+                    x = 0.5*(x0 + x1) - x_min
+                    y = 0.5*(y0 + y1) - y_min
+                    for i, (bx0, by0, bx1, by1) in enumerate(boxes):
+                        if bx0 <= x <= bx1 and by0 <= y <= by1:
+                            score_table.add(i)
+
+                score_table = sorted(score_table)
+                if len(score_table) == 1:
+                    scores.append(score_table[0])
+                elif len(score_table) == 0:
+                    scores.append(None)
+                else:
+                    scores.append("MULTI: " + str(score_table))
         return scores
 
 
-    def get_scores_df(self):
+    def page_digests(self, fname, maxpoints):
+
+        '''
+        Returns a list of digests of pages of a pdf file, used to find pages which
+        changed since scores were read from them. 
+
+        :fname:
+            The name of the pdf file.
+        :maxpoints:
+            The maximum point value of the graded problems, included in the digests.
+        '''
+
+        memo = {}
+        with open(fname, 'rb') as f:
+            reader = pdf.PdfFileReader(f)
+            return [page_digest(reader.getPage(n), extra = str(maxpoints), memo = memo) for n in range(reader.numPages)]
+
+
+    def read_file_scores(self, fname, maxpoints):
+
+        '''
+        Reads scores from score tables embedded in pages of a pdf file. Scores marked
+        with pdf annotations are read directly from annotations; only pages without
+        such marks are rendered, and scores are read from their images.
+
+        Scores read from a page are stored in grading data together with a digest
+        of the page, and they are reused as long as the page does not change, so 
+        only pages modified since scores were last read are processed. 
+
+        :fname:
+            The name of the pdf file.
+        :maxpoints:
+            The maximum point value of the graded problems.
+
+        Returns:
+            A list of scores, one for each pdf page, in the format of read_problem_scores.
+        '''
+
+        basename = os.path.basename(fname)
+        digests = self.page_digests(fname, maxpoints)
+        cache = self.grading_state.get_score_cache(basename)
+        scores = [cache.get(d) for d in digests]
+
+        changed = [n for n, d in enumerate(digests) if d not in cache]
+        if len(changed) > 0:
+            annotation_scores = self.read_annotation_scores(fname, maxpoints, pages = changed)
+            unread = [n for n, score in zip(changed, annotation_scores) if score is None]
+            for n, score in zip(changed, annotation_scores):
+                scores[n] = score
+            if len(unread) > 0:
+                raster_scores = self.read_problem_scores(fname = fname, maxpoints = maxpoints, pages = unread, geometry = self.table_geometry)
+                for n, score in zip(unread, raster_scores):
+                    scores[n] = score
+
+        # digests of pages no longer in the file are removed from the cache
+        new_cache = dict(zip(digests, scores))
+        if new_cache != cache:
+            self.grading_state.set_score_cache(basename, new_cache)
+        return scores
+
+
+    def get_scores_df(self, workers = 1):
 
         '''
         Reads scores from graded pdf files with exam problems.
 
+        :workers:
+            The number of processes reading scores. Each file with exam problems is 
+            processed by one of the processes. If 1, all files are processed in the
+            current process. 
+
         Returns:
             Pandas dataframe with exam scores. Rows are indexed with exam codes,
             columns with problem numbers. A "NONE" value in the dataframe indicates
@@ -93,37 +346,50 @@ class ReadScores(GradingBase):
         files = sorted([f for f in files if not covers_file(f)])
 
 
-        grading_data = self.get_grading_data()
         #  the list with max score for each problem
-        maxpoints = grading_data["maxpoints"]
+        maxpoints = self.grading_state.get_maxpoints()
         # the directory with lists with exam codes for each problem
-        page_lists = grading_data["page_lists"]
+        page_lists = self.grading_state.get_page_lists()
 
         # dictionary for recording problem scores; records of the form
         # prob_n : dictionary of scores for prob_n with keys given by exam codes
         score_dict = {}
 
-        # iterate over exam problem files
+        # files with problems worth more than 0 points, and their maximal scores
+        problem_files = []
         for fname in files:
-            basename = os.path.basename(fname)
-            print(f"Processing: {basename}" + 10*" " + "\r", end="")
-
             basename = os.path.basename(fname)
             # page/problem number
             page_num = (os.path.splitext(basename)[0]).split("_")[-1]
             # maximal possible score for the problem
             problem_max = maxpoints[page_num]
-
-            # read problem scores
             if problem_max > 0:
-                score_list = self.read_problem_scores(fname = fname, maxpoints = problem_max)
+                problem_files.append((fname, page_num, problem_max))
+
+        # read problem scores; with several workers files are processed in parallel,
+        # and the results are collected in the order of files
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers = workers) as executor:
+                futures = {executor.submit(self.read_file_scores, fname = fname, maxpoints = problem_max) : fname
+                           for fname, page_num, problem_max in problem_files}
+                for n, future in enumerate(as_completed(futures), start = 1):
+                    print(f"Processed: {os.path.basename(futures[future])} ({n}/{len(futures)})" + 10*" " + "\r", end="")
+                score_lists = [future.result() for future in futures]
+        else:
+            score_lists = []
+            for fname, page_num, problem_max in problem_files:
+                print(f"Processing: {os.path.basename(fname)}" + 10*" " + "\r", end="")
+                score_lists.append(self.read_file_scores(fname = fname, maxpoints = problem_max))
+
+        for (fname, page_num, problem_max), score_list in zip(problem_files, score_lists):
+            basename = os.path.basename(fname)
 
-                # associate problem scores with exam codes
-                pages = [ExamCode(f).get_exam_code() for f in  page_lists[basename]]
-                if len(pages) != len(score_list):
-                    return None
-                score_dict_page = {p:s for (p,s) in zip(pages, score_list)}
-                score_dict["page_" + page_num] = score_dict_page
+            # associate problem scores with exam codes
+            pages = [ExamCode(f).get_exam_code() for f in  page_lists[basename]]
+            if len(pages) != len(score_list):
+                return None
+            score_dict_page = {p:s for (p,s) in zip(pages, score_list)}
+            score_dict["page_" + page_num] = score_dict_page
 
         # convert the scores dictionary into dataframe with rows indexed by exam QR codes and
         # columns labeled prob_n where n is the problem numnber
@@ -134,7 +400,7 @@ class ReadScores(GradingBase):
         return scores_df
 
 
-    def get_scores(self, save = False, new_gradebook = None):
+    def get_scores(self, save = False, new_gradebook = None, workers = 1):
 
         '''
         Records exam scores in a gradebook with student data.
@@ -144,6 +410,8 @@ class ReadScores(GradingBase):
         :new_gradebook:
             The name of the csv file to save the data. If None, the data will be saved
             to self.gradebook.
+        :workers:
+            The number of processes reading scores from files with exam problems.
 
         Returns:
             A tuple (scores_df, new_gradebook_df) of pandas dataframes. scores_df contains
@@ -159,7 +427,7 @@ class ReadScores(GradingBase):
             new_gradebook = os.path.join(self.main_dir, os.path.basename(new_gradebook))
 
         # read exam scores
-        scores_df = self.get_scores_df()
+        scores_df = self.get_scores_df(workers = workers)
 
         problem_cols = scores_df.columns.tolist()
         # add a column with total score for each exam; since some rows may contain
@@ -168,7 +436,7 @@ class ReadScores(GradingBase):
         scores_df[self.total_column] = scores_temp[problem_cols].sum(axis=1).astype("int")
 
         # drop exam scores from the gradebook, to avoid duplicated columns
-        gradebook_df = pd.read_csv(self.gradebook, converters={self.qr_code_column : str})
+        gradebook_df = self.get_gradebook().df
         for col in problem_cols + [self.total_column]:
             try:
                 gradebook_df.drop(columns = col, inplace=True)
@@ -193,7 +461,7 @@ class ReadScores(GradingBase):
 
         # save to a csv file
         if save:
-            new_gradebook_df.to_csv(new_gradebook, index=False)
+            save_csv(new_gradebook_df, new_gradebook)
 
         print("Exam scores ready" + 40*" ")
         return scores_df, new_gradebook_df
@@ -5,20 +5,21 @@ from ubgrade.email_tools import EmailGradedExams
 
 
 
-def prep_grading(maxpoints, main_dir = None, gradebook = None, rotate=None, skip_codes = [], batch=False, files=None,  init_grading_data=False):
+def prep_grading(maxpoints, main_dir = None, gradebook = None, rotate=None, skip_codes = [], batch=False, files=None,  init_grading_data=False, workers=1, qr_time_budget=None, keep_pages=False, incremental=True):
     
     x = PrepareGrading(maxpoints = maxpoints, 
                        main_dir = main_dir, 
                        gradebook = gradebook, 
-                       init_grading_data=init_grading_data)
-    x.prepare_grading(files = files, rotate=rotate, skip_codes = skip_codes, batch = batch)
+                       init_grading_data=init_grading_data,
+                       qr_time_budget = qr_time_budget)
+    x.prepare_grading(files = files, rotate=rotate, skip_codes = skip_codes, batch = batch, workers = workers, keep_pages = keep_pages, incremental = incremental)
 
 
 
-def read_scores(main_dir = None, gradebook = None, new_gradebook = None):
+def read_scores(main_dir = None, gradebook = None, new_gradebook = None, workers = 1):
     
     x = ReadScores(main_dir = main_dir, gradebook = gradebook)
-    x.get_scores(save=True, new_gradebook = new_gradebook)
+    x.get_scores(save=True, new_gradebook = new_gradebook, workers = workers)
 
 
 